@@ -1,6 +1,8 @@
 from . import chipAnalysis
 from . import gprFilesToConcatFile
 from . import processConcat_PR8
+from . import exportOligoData
+from . import thresholdSweep
 from . import scatterPlotRep1vsRep2
 from . import outputDataForfREDUCE_newConcatFiles
 from . import runMultiFREDUCE
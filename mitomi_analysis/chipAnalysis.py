@@ -3,8 +3,10 @@ import os
 from getopt import getopt
 from . import chipSingleconcUtils
 from . import plotUtils
-import numpy as N
 from . import fileIOUtils
+from . import spotLayout
+from . import chipStages
+from . import igorUtils
 
 
 HELP_STRING = """
@@ -30,6 +32,12 @@ intensities.
      -t     chBSub threshold value (optional)
      -j     minimum y axis value for DNA Fg and Bg graphs
      -k     minimum y axis value for protein Fg and Bg graphs
+     -z     do not use the stage cache (.mitomi_cache next to the concat
+            file, never pruned: delete it to clear the cache)
+     -i     write the arrays as Igor binary waves (<array>.ibw) instead of
+            text matrices (<array>.txt)
+     -e     write the arrays as waves in a single Igor packed experiment
+            (ChipArrays.pxp) instead of text matrices
 
 Example:
 mitomi chip-analysis -c concatFile_042108.txt -p 50 -d 1 -t 100 -j 600 -k 1400
@@ -51,9 +59,12 @@ def main(argv=None):
     chTh = 1000
     DNAYMin = -1
     pYMin = -1
+    cacheFlag = 1
+    ibwFlag = 0
+    pxpFlag = 0
 
     try:
-        optlist, args = getopt(argv[1:], "hc:p:d:t:j:k:s:")
+        optlist, args = getopt(argv[1:], "hc:p:d:t:j:k:s:zie")
     except:
         print("")
         print(HELP_STRING)
@@ -85,132 +96,132 @@ def main(argv=None):
             DNAYMin = int(opt_arg)
         elif opt == '-k':
             pYMin = int(opt_arg)
+        elif opt == '-z':
+            cacheFlag = 0
+        elif opt == '-i':
+            ibwFlag = 1
+        elif opt == '-e':
+            pxpFlag = 1
 
     if concatFileName == "":
         print(HELP_STRING)
         sys.exit(1)
 
-    # get lists from concat file
-    blockL, oRL, oCL, rows, cols, diaL, flagL, pFL, dFL, pBL, dBL, cFL = \
-        chipSingleconcUtils.concatFileToLists(concatFileName)
+    stages = chipStages.getChipStages(concatFileName, spot2OligoFileName,
+                                      cacheFlag=cacheFlag)
+    analyzeChip(stages, pTh=pTh, DNATh=DNATh, chTh=chTh, DNAYMin=DNAYMin,
+                pYMin=pYMin, ibwFlag=ibwFlag, pxpFlag=pxpFlag)
 
-    # determine spots per column and number of columns
-    numCols, spotsPerCol = \
-        chipSingleconcUtils.determineDimensions(concatFileName)
+    return 0
+
+
+def analyzeChip(stages, pTh=1, DNATh=1, chTh=1000, DNAYMin=-1, pYMin=-1,
+                outDir=None, ibwFlag=0, pxpFlag=0):
+    """This program writes the chip analysis heat maps, arrays and graphs for
+    the chip handled by a ChipStages object, in outDir (by default the
+    directory of the concat file).  The arrays are written as text matrices,
+    or as Igor binary waves (ibwFlag) and/or an Igor packed experiment
+    (pxpFlag)."""
+
+    concatFileName = stages.concatFileName
+
+    # get the chip data, spots per column and number of columns from the
+    # concat file
+    chip = stages.load()
+    rows, cols = chip.row, chip.col
+    numCols, spotsPerCol = chip.numCols, chip.spotsPerCol
 
     print(numCols, spotsPerCol)
     dimensions = (spotsPerCol, numCols)
 
-    # create N.arrays to hold all of the data
-    DNAFgArray = N.zeros(dimensions)
-    DNABgArray = N.zeros(dimensions)
-    DNABSubArray = N.zeros(dimensions)
-    pFgArray = N.zeros(dimensions)
-    pBgArray = N.zeros(dimensions)
-    pBSubArray = N.zeros(dimensions)
-    chBSubArray = N.zeros(dimensions)
-    flagArray = N.zeros(dimensions)
-    oligoArray = N.zeros(dimensions)
-    ratioArray = N.zeros(dimensions, float)
-
-    # create dictionaries linking spot index to oligo name and dilution
-    oligoD = chipSingleconcUtils.makeSpot2OligoDict(spot2OligoFileName)
+    # look up the oligo number of each spot
+    layout = spotLayout.loadSpotLayout(stages.spot2OligoFileName)
+    oligoNums = layout.spotOligoNums(cols, rows)
 
     # deal with flagged spots
-    flags, pFg, DNAFg, pBg, DNABg, chFg = \
-        chipSingleconcUtils.zeroFlaggedSpots(flagL, pFL, dFL, pBL, dBL, cFL)
-
-    # create pBSub, DNABSub, and chBSub lists
-    pBSub, DNABSub, chBSub = \
-        chipSingleconcUtils.backgroundSubtract(pFL,
-                                               pBL,
-                                               dFL,
-                                               dBL,
-                                               cFL,
-                                               dBL,
-                                               pTh=pTh,
-                                               dTh=DNATh,
-                                               cTh=chTh)
+    flaggedChip = stages.flag()
+    flags, pFg, DNAFg, pBg, DNABg, chFg = (
+        flaggedChip.flag, flaggedChip.pFg, flaggedChip.DNAFg, flaggedChip.pBg,
+        flaggedChip.DNABg, flaggedChip.chFg)
+
+    # create pBSub, DNABSub, and chBSub lists (from the raw intensities)
+    pBSub, DNABSub, chBSub = stages.bgsub(pTh, DNATh, chTh, 0, flagged=0)
 
     # create ratio and ratioNorm lists
     ratio, ratioNorm, ratioNormNorm, chBSubMean = \
-        chipSingleconcUtils.calculateRatios(pBSub, DNABSub, chBSub)
-
-    # fill arrays with data
-    for n in range(0, len(rows)):
-        DNAFgArray[rows[n] - 1][cols[n] - 1] = DNAFg[n]
-        DNABgArray[rows[n] - 1][cols[n] - 1] = DNABg[n]
-        DNABSubArray[rows[n] - 1][cols[n] - 1] = DNABSub[n]
-        pFgArray[rows[n] - 1][cols[n] - 1] = pFg[n]
-        pBgArray[rows[n] - 1][cols[n] - 1] = pBg[n]
-        pBSubArray[rows[n] - 1][cols[n] - 1] = pBSub[n]
-        chBSubArray[rows[n] - 1][cols[n] - 1] = chBSub[n]
-        if flags[n] != 0:
-            flagArray[rows[n] - 1][cols[n] - 1] = 1
-        spotIndex = str(cols[n]) + "." + str(rows[n])
-        oligo = oligoD[spotIndex]
-        oligoArray[rows[n] - 1][cols[n] - 1] = int(oligo.split("_")[1])
-        ratioArray[rows[n] - 1][cols[n] - 1] = ratio[n]
+        stages.ratios(pTh, DNATh, chTh, 0, flagged=0)
+
+    # place the data on the chip grid
+    listOfArrays = chipSingleconcUtils.gridArray(
+        cols, rows, [DNAFg, DNABg, DNABSub, pFg, pBg, pBSub, chBSub,
+                     flags != 0, oligoNums, ratio], dimensions)
 
     # create a new directory to hold the chip analysis graphs
-    dataDir = (os.path.split(concatFileName)[0]
+    dataDir = (outDir if outDir is not None
+               else os.path.split(concatFileName)[0]
                if os.path.split(concatFileName)[0] != ""
                else ".")
     analysisDir = str(dataDir) + "/ChipAnalysis/"
     fileIOUtils.createNewDir(analysisDir)
     threshFileName = analysisDir + "Thresholds.txt"
-    chipSingleconcUtils.writeThresholdsToFile(threshFileName, pTh, DNATh, chTh)
-
-    # display the data
-    listOfArrays = [DNAFgArray, DNABgArray, DNABSubArray, pFgArray,
-                    pBgArray, pBSubArray, chBSubArray, flagArray,
-                    oligoArray, ratioArray]
-    listOfFilenames = ["DNAFgArray", "DNABgArray", "DNABSubArray", "pFgArray",
-                       "pBgArray", "pBSubArray", "chBSubArray", "flagArray",
-                       "oligoArray", "ratioArray"]
-    listOfColormaps = [1, 1, 1, 2, 2, 2, 1, 1, 1, 1]
-    for n in range(0, len(listOfArrays)):
-        figFileRoot = analysisDir + listOfFilenames[n]
-        plotUtils.createAndSaveHeatMap(listOfArrays[n], figFileRoot,
-                                       xLabel="Columns", yLabel="Spots",
-                                       xMax=0, xMin=numCols, yMax=0,
-                                       yMin=spotsPerCol,
-                                       colorMap=listOfColormaps[n],
-                                       vMin=0, majorFontSize=16)
-
-    # ok, now write out the arrays to text files to use for creating heat maps
-    # in igor.
-    for n in range(0, len(listOfArrays)):
-        outFileName = analysisDir + listOfFilenames[n] + '.txt'
-        outFile = open(outFileName, 'w')
-        for m in range(0, dimensions[0]):
-            for l in range(0, dimensions[1]):
-                outFile.write(str(listOfArrays[n][m][l]) + '\t')
-            outFile.write('\n')
-        outFile.close()
-
-    graphDataList = [rows, pFg, DNAFg, pBg, DNABg,
-                     chFg, pBSub, DNABSub, chBSub, ratio, ratioNorm]
-    graphNameList = ["rows", "pFg", "DNAFg", "pBg", "DNABg",
-                     "chFg", "pBSub", "DNABSub", "chBSub", "ratio",
-                     "ratioNorm"]
-    xLabel = "Column Position"
-    yMinList = [-1, pYMin, DNAYMin, pYMin, DNAYMin, -1, -1, -1, 0, -1, -1]
-
-    for n in range(1, len(graphDataList)):
-        if (n <= 8):
-            yLabel = "Intensity"
-        else:
-            if n == 9:
-                yLabel = "Ratio"
-            if n == 10:
-                yLabel = "Normalized Ratio"
-        figFileName = analysisDir + graphNameList[n]
-        plotUtils.createAndSaveFig(graphDataList[0], graphDataList[n],
-                                   xLabel=xLabel, yLabel=yLabel,
-                                   figFileRoot=figFileName, yMin=yMinList[n])
 
-    return 0
+    # the files are written on a background thread while the graphs are
+    # drawn
+    with fileIOUtils.OutputWriter() as writer:
+        writer.submit(chipSingleconcUtils.writeThresholdsToFile,
+                      threshFileName, pTh, DNATh, chTh)
+
+        # write out the arrays to use for creating heat maps in igor
+        listOfFilenames = ["DNAFgArray", "DNABgArray", "DNABSubArray",
+                           "pFgArray", "pBgArray", "pBSubArray", "chBSubArray",
+                           "flagArray", "oligoArray", "ratioArray"]
+        if ibwFlag != 0:
+            for n in range(0, len(listOfArrays)):
+                writer.submit(igorUtils.writeIgorWave,
+                              analysisDir + listOfFilenames[n] + '.ibw',
+                              listOfArrays[n], listOfFilenames[n])
+        if pxpFlag != 0:
+            writer.submit(igorUtils.writePackedExperiment,
+                          analysisDir + 'ChipArrays.pxp', listOfFilenames,
+                          listOfArrays)
+        if ibwFlag == 0 and pxpFlag == 0:
+            for n in range(0, len(listOfArrays)):
+                writer.submit(igorUtils.writeTextMatrix,
+                              analysisDir + listOfFilenames[n] + '.txt',
+                              listOfArrays[n])
+
+        # display the data
+        listOfColormaps = [1, 1, 1, 2, 2, 2, 1, 1, 1, 1]
+        for n in range(0, len(listOfArrays)):
+            figFileRoot = analysisDir + listOfFilenames[n]
+            plotUtils.createAndSaveHeatMap(listOfArrays[n], figFileRoot,
+                                           xLabel="Columns", yLabel="Spots",
+                                           xMax=0, xMin=numCols, yMax=0,
+                                           yMin=spotsPerCol,
+                                           colorMap=listOfColormaps[n],
+                                           vMin=0, majorFontSize=16)
+
+        graphDataList = [rows, pFg, DNAFg, pBg, DNABg,
+                         chFg, pBSub, DNABSub, chBSub, ratio, ratioNorm]
+        graphNameList = ["rows", "pFg", "DNAFg", "pBg", "DNABg",
+                         "chFg", "pBSub", "DNABSub", "chBSub", "ratio",
+                         "ratioNorm"]
+        xLabel = "Column Position"
+        yMinList = [-1, pYMin, DNAYMin, pYMin, DNAYMin, -1, -1, -1, 0, -1, -1]
+
+        for n in range(1, len(graphDataList)):
+            if (n <= 8):
+                yLabel = "Intensity"
+            else:
+                if n == 9:
+                    yLabel = "Ratio"
+                if n == 10:
+                    yLabel = "Normalized Ratio"
+            figFileName = analysisDir + graphNameList[n]
+            plotUtils.createAndSaveFig(graphDataList[0], graphDataList[n],
+                                       xLabel=xLabel, yLabel=yLabel,
+                                       figFileRoot=figFileName,
+                                       yMin=yMinList[n])
 
 
 ##############################################
@@ -0,0 +1,84 @@
+import numpy as N
+
+
+# spot fields read from a concat file: field name, concat column name, and
+# the type the field is held as
+CONCAT_FIELDS = [('block', 'Block', N.int16),
+                 ('origCol', 'Column', N.int16),
+                 ('origRow', 'Row', N.int16),
+                 ('col', 'OutColumn', N.int16),
+                 ('row', 'OutRow', N.int16),
+                 ('dia', 'Dia', N.int16),
+                 ('flag', 'Flag', N.int8),
+                 ('pFg', 'P_FG', N.float64),
+                 ('DNAFg', 'DNA_FG', N.float64),
+                 ('pBg', 'P_BG', N.float64),
+                 ('DNABg', 'DNA_BG', N.float64),
+                 ('chFg', 'CH_FG', N.float64)]
+
+# spot fields calculated during processing (a type of None keeps the type of
+# the values given)
+DERIVED_FIELDS = [('pBSub', N.float64),
+                  ('DNABSub', N.float64),
+                  ('chBSub', N.float64),
+                  ('ratio', N.float64),
+                  ('ratioNorm', N.float64),
+                  ('oligoNum', None)]
+
+# layout summary of the concat file (see chipSingleconcUtils.concatInfo)
+INFO_FIELDS = ['numCols', 'spotsPerCol', 'numBlocks', 'numSpots',
+               'numFlagged', 'flagCounts']
+
+
+class ChipData(object):
+    """This class holds the spots of a single chip as one contiguous, typed
+    array per field, e.g. chip.pFg or chip['pFg'], along with the layout
+    summary of the concat file it was read from."""
+
+    __slots__ = ([field[0] for field in CONCAT_FIELDS] +
+                 [field[0] for field in DERIVED_FIELDS] + INFO_FIELDS)
+
+    def __init__(self, info=None, **fields):
+
+        for name, dtype in ([(field[0], field[2]) for field in CONCAT_FIELDS] +
+                            DERIVED_FIELDS):
+            value = fields.pop(name, None)
+            if value is not None:
+                value = N.asarray(value, dtype)
+            setattr(self, name, value)
+        if len(fields) != 0:
+            raise TypeError("Unknown chip fields: " + ", ".join(fields))
+
+        if info is None:
+            info = {}
+        for name in INFO_FIELDS:
+            setattr(self, name, info.get(name))
+
+    def __len__(self):
+        return len(self.flag)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def info(self):
+        """This program returns the layout summary as a dictionary."""
+
+        return dict((name, getattr(self, name)) for name in INFO_FIELDS)
+
+    def fields(self):
+        """This program returns a dictionary of the fields that are set."""
+
+        outD = {}
+        for name in ([field[0] for field in CONCAT_FIELDS] +
+                     [field[0] for field in DERIVED_FIELDS]):
+            if getattr(self, name) is not None:
+                outD[name] = getattr(self, name)
+        return outD
+
+    def replace(self, **fields):
+        """This program returns a copy of the chip with some fields replaced;
+        the arrays that are not replaced are shared, not copied."""
+
+        newFields = self.fields()
+        newFields.update(fields)
+        return ChipData(info=self.info(), **newFields)
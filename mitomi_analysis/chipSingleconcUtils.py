@@ -1,168 +1,254 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 import numpy as N
 from . import fitUtils
+from . import fileIOUtils
+from .chipData import ChipData, CONCAT_FIELDS
+from . import spotLayout
 
 
 def makeSpot2OligoDict(spot2OligoFileName):
     """This program takes a spot2Oligo file and creates a
     dictionary containing the oligo names for each spot."""
 
-    spot2OligoFile = open(spot2OligoFileName, 'r')
-    oligoD = {}
-
-    lineIndex = 0
-    for line in spot2OligoFile:
-        lineIndex = lineIndex + 1
-        # this next part just skips the header
-        if lineIndex == 1:
-            pass
-        else:
-            tempList = line.split('\t')
-            col = tempList[0].strip()
-            row = tempList[1].strip()
-            oligo = tempList[2].strip()
-            spotIndex = col+"."+row
-            oligoD[spotIndex] = oligo
-
-    spot2OligoFile.close()
-    return oligoD
-
-
-def concatGprFiles(pFN, cFN, dFN, oFN, singleF=0, rlF=0, tbF=0):
-
-    dF = open(dFN, 'r')
-    cF = open(cFN, 'r')
-
-    blockL, colL, rowL, diaL, flagL, pFL, pBL, dFL, dBL, cFL = \
-        [], [], [], [], [], [], [], [], [], []
-
-    # open up protein file and read in data
-    lI = 0
-    colsPerBlock = 0
-    pF = open(pFN, 'r')
-    for line in pF:
-        lI = lI + 1
-        if lI <= 32:
-            pass
-        else:
-            tempL = line.strip().split('\t')
-            blockL.append(int(tempL[0]))
-            colL.append(int(tempL[1]))
-            rowL.append(int(tempL[2]))
-            diaL.append(int(tempL[7]))
-            pFL.append(int(tempL[8]))
-            pBL.append(int(tempL[13]))
-            flagL.append(int(tempL[37]))
-            if int(tempL[1]) > colsPerBlock:
-                colsPerBlock = int(tempL[1])
-
-    pF.close()
-
-    # open up DNA file and read in data
-    lI, rI = 0, -1
-    dF = open(dFN, 'r')
-    for line in dF:
-        lI = lI + 1
-        if lI <= 32:
-            pass
-        else:
-            rI = rI + 1
-            tempL = line.strip().split('\t')
-            dFL.append(int(tempL[8]))
-            dBL.append(int(tempL[13]))
-            if int(tempL[37]) != 0:
-                flagL[rI] = int(tempL[37])
-    dF.close()
-
-    # open up chamber DNA file and read in data
-    lI, rI = 0, -1
-    cF = open(cFN, 'r')
-    for line in cF:
-        lI = lI + 1
-        if lI <= 32:
-            pass
-        else:
-            rI = rI + 1
-            tempL = line.strip().split('\t')
-            cFL.append(int(tempL[8]))
-            if int(tempL[37]) != 0:
-                flagL[rI] = int(tempL[37])
-    cF.close()
+    return spotLayout.loadSpotLayout(spot2OligoFileName).toDict()
+
+
+# GenePix columns needed for a concat file: the name (as a pattern, since the
+# intensity columns carry the scan wavelength) and the position used when the
+# ATF header cannot be parsed
+GPR_COLUMNS = [('block', r'Block$', 0), ('col', r'Column$', 1),
+               ('row', r'Row$', 2), ('dia', r'Dia\.$', 7),
+               ('fg', r'F\d+ Median$', 8), ('bg', r'B\d+ Median$', 13),
+               ('flag', r'Flags$', 37)]
+
+# GenePix flag for a feature that is absent from a channel
+ABSENT_FLAG = -75
+
+
+def readGprHeader(gprFile):
+    """This program reads the ATF header of an open GenePix results file,
+    leaving the file positioned at the first spot, and returns the list of
+    column names (or None if the header could not be parsed)."""
+
+    lines = [gprFile.readline(), gprFile.readline()]
+    try:
+        if not lines[0].startswith('ATF'):
+            raise ValueError
+        numHeaderRecords = int(lines[1].split('\t')[0])
+    except ValueError:
+        # not a well-formed ATF file, so fall back to the fixed header length
+        for a in range(2, 32):
+            gprFile.readline()
+        return None
+
+    for a in range(0, numHeaderRecords):
+        gprFile.readline()
+    colNames = gprFile.readline().strip().split('\t')
+
+    return [name.strip().strip('"') for name in colNames]
+
+
+def readGprFile(gprFileName, columns=GPR_COLUMNS):
+    """This program reads the required columns of a GenePix results file into
+    a dictionary of integer arrays in a single bulk pass, locating each column
+    by name in the ATF header."""
+
+    gprFile = fileIOUtils.openFile(gprFileName, 'r')
+    colNames = readGprHeader(gprFile)
+
+    indices = []
+    for key, pattern, legacyIndex in columns:
+        index = legacyIndex
+        if colNames is not None:
+            for n in range(0, len(colNames)):
+                if re.match(pattern, colNames[n]):
+                    index = n
+                    break
+        indices.append(index)
+
+    data = N.loadtxt(gprFile, delimiter='\t', usecols=indices, dtype=N.int64,
+                     quotechar='"', ndmin=2)
+    gprFile.close()
+
+    return dict((columns[n][0], data[:, n]) for n in range(0, len(columns)))
+
+
+def readGprFiles(gprFileNames, numWorkers=3):
+    """This program reads several GenePix results files concurrently and
+    returns their column dictionaries in the order the files were given."""
+
+    if numWorkers <= 1:
+        return [readGprFile(fileName) for fileName in gprFileNames]
+
+    # the reads are I/O bound, so threads overlap them without pickling the
+    # arrays back from worker processes
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        return list(executor.map(readGprFile, gprFileNames))
+
+
+def mergeFlags(flagArrays):
+    """This program combines the flags from each channel into one flag per
+    spot; a non-zero flag in a later channel overrides earlier ones."""
+
+    flags = flagArrays[0]
+    for channelFlags in flagArrays[1:]:
+        flags = N.where(channelFlags != 0, channelFlags, flags)
+
+    return flags
+
+
+def spotKeys(gprData):
+    """This program packs the block, column and row of each spot into a single
+    integer key."""
+
+    return (gprData['block'] << 40) | (gprData['col'] << 20) | gprData['row']
+
+
+def joinGprChannel(refData, gprData, gprFileName=""):
+    """This program matches the spots of one channel to the spots of the
+    reference channel by (Block, Column, Row) rather than by line number.
+    Reference spots missing from the channel are given zero intensities and
+    the GenePix 'absent' flag so that later steps discard them."""
+
+    refKeys = spotKeys(refData)
+    keys = spotKeys(gprData)
+    if N.array_equal(refKeys, keys):
+        return gprData
+
+    order = N.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+    pos = N.searchsorted(sortedKeys, refKeys)
+    pos[pos == len(sortedKeys)] = 0
+    if len(sortedKeys) > 0:
+        matched = sortedKeys[pos] == refKeys
+    else:
+        matched = N.zeros(len(refKeys), bool)
+    index = order[pos[matched]]
+
+    numMissing = N.count_nonzero(~matched)
+    numExtra = N.count_nonzero(~N.isin(keys, refKeys))
+    numDuplicate = N.count_nonzero(sortedKeys[1:] == sortedKeys[:-1])
+    if numMissing or numExtra or numDuplicate:
+        print(gprFileName + ": " + str(numMissing) + " spots missing, " +
+              str(numExtra) + " unmatched spots, " + str(numDuplicate) +
+              " duplicate spots")
+        for spot in N.flatnonzero(~matched)[:10]:
+            print("  missing Block " + str(refData['block'][spot]) +
+                  ", Column " + str(refData['col'][spot]) + ", Row " +
+                  str(refData['row'][spot]))
+
+    joined = {}
+    for key in gprData:
+        joined[key] = N.zeros(len(refKeys), gprData[key].dtype)
+        joined[key][matched] = gprData[key][index]
+    joined['flag'][~matched] = ABSENT_FLAG
+
+    return joined
+
+
+def concatGprFiles(pFN, cFN, dFN, oFN, singleF=0, rlF=0, tbF=0,
+                   numWorkers=3, storeF=0):
+
+    pD, dD, cD = readGprFiles([pFN, dFN, cFN], numWorkers=numWorkers)
+
+    # line up the DNA and chamber spots with the protein spots
+    dD = joinGprChannel(pD, dD, dFN)
+    cD = joinGprChannel(pD, cD, cFN)
+
+    # a flag in the DNA or chamber channel overrides the protein flag
+    flags = mergeFlags([pD['flag'], dD['flag'], cD['flag']])
 
     # if files were not gridded as a single block, renumber to fix this
-    tempColL = []
-    for a in range(0, len(blockL)):
-        if singleF != 0:
-            tempColL.append((blockL[a]-1)*colsPerBlock+colL[a])
-        else:
-            tempColL.append(colL[a])
+    colsPerBlock = pD['col'].max(initial=0)
+    if singleF != 0:
+        tempCols = (pD['block'] - 1) * colsPerBlock + pD['col']
+    else:
+        tempCols = pD['col']
 
     # figure out the total number of columns and rows
-    numCols, numRows = 0, 0
-    for a in range(0, len(blockL)):
-        if tempColL[a] > numCols:
-            numCols = tempColL[a]
-        if rowL[a] > numRows:
-            numRows = rowL[a]
+    numCols = tempCols.max(initial=0)
+    numRows = pD['row'].max(initial=0)
 
     # renumber columns in case file must be renumbered left to right
-    outColL = []
-    for a in range(0, len(blockL)):
-        if rlF != 0:
-            outColL.append(numCols+1-tempColL[a])
-        else:
-            outColL.append(tempColL[a])
+    outCols = numCols + 1 - tempCols if rlF != 0 else tempCols
 
     # renumber columns in case file must be renumbered top to bottom
-    outRowL = []
-    for a in range(0, len(blockL)):
-        if tbF != 0:
-            outRowL.append(numRows+1-rowL[a])
-        else:
-            outRowL.append(rowL[a])
-
-    oF = open(oFN, 'w')
+    outRows = numRows + 1 - pD['row'] if tbF != 0 else pD['row']
+
+    oF = fileIOUtils.openAtomic(oFN, 'w')
     str1 = "Block\tColumn\tRow\tOutColumn\tOutRow\tDia\tFlag\tP_FG\tDNA_FG\t\
         P_BG\tDNA_BG\tCH_FG\n"
     oF.write(str1)
-    for a in range(0, len(blockL)):
-        oL = [str(blockL[a]), str(colL[a]), str(rowL[a]), str(outColL[a]),
-              str(outRowL[a]), str(diaL[a]), str(flagL[a]), str(pFL[a]),
-              str(dFL[a]), str(pBL[a]), str(dBL[a]), str(cFL[a])]
-        oF.write('\t'.join(oL))
-        oF.write('\n')
+    outCols = [pD['block'], pD['col'], pD['row'], outCols, outRows, pD['dia'],
+               flags, pD['fg'], dD['fg'], pD['bg'], dD['bg'], cD['fg']]
+    N.savetxt(oF, N.column_stack(outCols), fmt='%d', delimiter='\t')
+    oF.close()
+
+    # optionally save a binary copy that later steps can memory-map
+    if storeF != 0:
+        chip = ChipData(**dict((CONCAT_FIELDS[n][0], outCols[n])
+                               for n in range(0, len(CONCAT_FIELDS))))
+        fileIOUtils.writeColumnStore(
+            fileIOUtils.columnStoreName(oFN),
+            [field[1] for field in CONCAT_FIELDS],
+            [chip[field[0]] for field in CONCAT_FIELDS],
+            header={'info': concatInfo(chip)})
+
+
+def concatInfo(chip):
+    """This program summarizes the layout of a chip: the number of columns
+    and spots per column (as determineDimensions), the number of blocks and
+    spots, and the number of spots carrying each flag."""
+
+    flagValues, flagCounts = N.unique(chip.flag, return_counts=True)
+
+    return {'numCols': max(int(chip.col.max(initial=0)), 1),
+            'spotsPerCol': max(int(chip.row.max(initial=0)), 1),
+            'numBlocks': int(len(N.unique(chip.block))),
+            'numSpots': int(len(chip.flag)),
+            'numFlagged': int(N.count_nonzero(chip.flag)),
+            'flagCounts': dict((str(int(flagValues[n])), int(flagCounts[n]))
+                               for n in range(0, len(flagValues)))}
+
+
+def loadConcatFile(concatFileName):
+    """This program reads a concat file in a single pass into a ChipData
+    object, including the layout summary from concatInfo.  A binary column
+    store saved alongside the file is memory-mapped instead of parsing the
+    text, and its stored summary is used as is."""
+
+    storeName = fileIOUtils.findColumnStore(concatFileName)
+    if storeName is not None:
+        columnD, header = fileIOUtils.readColumnStore(storeName)
+        fields = dict((field[0], columnD[field[1]]) for field in CONCAT_FIELDS)
+        info = header.get('info')
+    else:
+        concatFile = fileIOUtils.openFile(concatFileName, 'r')
+        data = N.loadtxt(concatFile, delimiter='\t', skiprows=1,
+                         usecols=range(0, len(CONCAT_FIELDS)), ndmin=2)
+        concatFile.close()
+        fields = dict((CONCAT_FIELDS[n][0], data[:, n])
+                      for n in range(0, len(CONCAT_FIELDS)))
+        info = None
+
+    chip = ChipData(**fields)
+    if info is None:
+        info = concatInfo(chip)
+
+    return ChipData(info=info, **chip.fields())
 
 
 def concatFileToLists(concatFileName):
     """This program takes a concatenated Genepix results file
-    and creates dictionaries of all of the data for further analysis."""
-
-    blockL, oRL, oCL = [], [], []
-    rowL, colL, diaL, flagL = [], [], [], []
-    pFL, dFL, pBL, dBL, cFL = [], [], [], [], []
-
-    inFile = open(concatFileName, 'r')
-    lineIndex = 0
-
-    for line in inFile:
-        lineIndex = lineIndex + 1
-        if lineIndex == 1:
-            pass
-        else:
-            tempL = line.split('\t')
-            blockL.append(int(tempL[0]))
-            oCL.append(int(tempL[1]))
-            oRL.append(int(tempL[2]))
-            colL.append(int(tempL[3]))
-            rowL.append(int(tempL[4]))
-            diaL.append(float(tempL[5]))
-            flagL.append(float(tempL[6]))
-            pFL.append(float(tempL[7]))
-            dFL.append(float(tempL[8]))
-            pBL.append(float(tempL[9]))
-            dBL.append(float(tempL[10]))
-            cFL.append(float(tempL[11]))
-
-    return blockL, oRL, oCL, rowL, colL, diaL, flagL, pFL, dFL, pBL, dBL, cFL
+    and creates arrays of all of the data for further analysis."""
+
+    chip = loadConcatFile(concatFileName)
+
+    return (chip.block, chip.origRow, chip.origCol, chip.row, chip.col,
+            chip.dia, chip.flag, chip.pFg, chip.DNAFg, chip.pBg, chip.DNABg,
+            chip.chFg)
 
 
 def zeroFlaggedSpots(flagList, pFgList, DNAFgList, pBgList, DNABgList,
@@ -170,49 +256,35 @@ def zeroFlaggedSpots(flagList, pFgList, DNAFgList, pBgList, DNABgList,
     """This program checks to see if any spots have non-zero flags.
     If they do,  the program enters 'NaN' for their values."""
 
-    newPFg, newDNAFg, newPBg, newDNABg, newChFg = [], [], [], [], []
-    listOfLists = [pFgList, DNAFgList, pBgList, DNABgList, chFgList]
-    listOfNewLists = [newPFg, newDNAFg, newPBg, newDNABg, newChFg]
+    flagged = N.asarray(flagList).astype(int) != 0
 
-    for m in range(0, len(flagList)):
-        if int(flagList[m]) != 0:
-            for n in range(0, len(listOfNewLists)):
-                listOfNewLists[n].append(N.NaN)
-        else:
-            for n in range(0, len(listOfNewLists)):
-                listOfNewLists[n].append(listOfLists[n][m])
+    newLists = []
+    for inList in [pFgList, DNAFgList, pBgList, DNABgList, chFgList]:
+        newList = N.array(inList, float)
+        newList[flagged] = N.nan
+        newLists.append(newList)
+    newPFg, newDNAFg, newPBg, newDNABg, newChFg = newLists
 
     return flagList, newPFg, newDNAFg, newPBg, newDNABg, newChFg
 
 
 def backgroundSubtract(pFg, pBg, DNAFg, DNABg, chFg, chBg, pTh=0, dTh=0,
                           cTh=0, nanF=0):
-
-    pBSub, dBSub, chBSub = [], [], []
-
-    for a in range(0, len(pFg)):
-        if (N.isnan(pFg[a]) or N.isnan(pBg[a]) or N.isnan(DNAFg[a]) or
-                N.isnan(DNABg[a]) or N.isnan(chFg[a]) or N.isnan(chBg[a])):
-            pBSub.append(N.nan)
-            dBSub.append(N.nan)
-            chBSub.append(N.nan)
-        else:
-            tempP = pFg[a]-pBg[a]
-            tempD = DNAFg[a]-DNABg[a]
-            tempC = chFg[a]-chBg[a]
-            if nanF == 0:
-                pBSub.append(tempP)
-                dBSub.append(tempD)
-                chBSub.append(tempC)
-            else:
-                if tempP < pTh or tempD < dTh or tempC < cTh:
-                    pBSub.append(N.nan)
-                    dBSub.append(N.nan)
-                    chBSub.append(N.nan)
-                else:
-                    pBSub.append(tempP)
-                    dBSub.append(tempD)
-                    chBSub.append(tempC)
+    """This program subtracts the background from each channel.  Spots with
+    a NaN in any input (or, if nanF is set, with any background subtracted
+    value below its threshold) are NaN in all three outputs."""
+
+    pBSub = N.asarray(pFg, float) - N.asarray(pBg, float)
+    dBSub = N.asarray(DNAFg, float) - N.asarray(DNABg, float)
+    chBSub = N.asarray(chFg, float) - N.asarray(chBg, float)
+
+    # NaN inputs propagate through the differences
+    nanMask = N.isnan(pBSub) | N.isnan(dBSub) | N.isnan(chBSub)
+    if nanF != 0:
+        nanMask |= (pBSub < pTh) | (dBSub < dTh) | (chBSub < cTh)
+    pBSub[nanMask] = N.nan
+    dBSub[nanMask] = N.nan
+    chBSub[nanMask] = N.nan
 
     return pBSub, dBSub, chBSub
 
@@ -221,70 +293,168 @@ def writeThresholdsToFile(fileName, pTh, DNATh, chTh):
     """This program just records what thresholds were used in the analysis and
     writes them to file."""
 
-    thFile = open(fileName, 'w')
+    thFile = fileIOUtils.openAtomic(fileName, 'w')
     thFile.write("Protein threshold = "+str(pTh)+"\n")
     thFile.write("DNA threshold = "+str(DNATh)+"\n")
     thFile.write("Chamber threshold = "+str(chTh)+"\n")
     thFile.close()
 
 
+def writeBootstrapCIs(fileName, bootD, numResamples, method='gaussian'):
+    """This program writes the normalization fit parameters of each channel
+    with their bootstrap confidence intervals (see ChipStages.bootstrap),
+    noting the normalization method they were found with."""
+
+    lines = ['# 95% confidence intervals of the ' + method +
+             ' normalization fits from ' + str(numResamples) +
+             ' bootstrap resamples',
+             'Channel\tFitMean\tFitMeanLo\tFitMeanHi\tFitStd\tFitStdLo\t'
+             'FitStdHi']
+    for name in bootD:
+        lines.append('\t'.join([name] + [repr(float(a))
+                                         for a in bootD[name]]))
+    fileIOUtils.writeFile(fileName, '\n'.join(lines) + '\n')
+
+
 def calculateRatios(pBSubList, DNABSubList, chBSubList):
     """This program calculates (1) fluorescence intensity ratios
     and (2) normalized fluorescence intensity ratios."""
 
-    ratioList, ratioNormList, ratioNormNormList = [], [], []
-
-    newChBSubList = []
-
-    for a in chBSubList:
-        if not N.isnan(float(a)):
-            newChBSubList.append(a)
-    chBSubMean = N.mean(newChBSubList)
-
-    for n in range(0, len(pBSubList)):
-        if not N.isnan(pBSubList[n]) and pBSubList[n] != 0:
-            tempRatio = float(DNABSubList[n]) / float(pBSubList[n])
-            if chBSubList[n] > 0:
-                tempRatioNorm = (float(tempRatio) / float(chBSubList[n]))
-                tempRatioNormNorm = float(tempRatioNorm) * float(chBSubMean)
-            else:
-                tempRatioNorm = N.NaN
-                tempRatioNormNorm = N.NaN
-        else:
-            tempRatio = N.NaN
-            tempRatioNorm = N.NaN
-            tempRatioNormNorm = N.NaN
-        ratioList.append(tempRatio)
-        ratioNormList.append(tempRatioNorm)
-        ratioNormNormList.append(tempRatioNormNorm)
+    pBSub = N.asarray(pBSubList, float)
+    DNABSub = N.asarray(DNABSubList, float)
+    chBSub = N.asarray(chBSubList, float)
+
+    chBSubMean = N.mean(chBSub[~N.isnan(chBSub)])
+
+    ratioList = N.full(len(pBSub), N.nan)
+    ratioNormList = N.full(len(pBSub), N.nan)
+    hasRatio = ~N.isnan(pBSub) & (pBSub != 0)
+    ratioList[hasRatio] = DNABSub[hasRatio] / pBSub[hasRatio]
+    hasNorm = hasRatio & (chBSub > 0)
+    ratioNormList[hasNorm] = ratioList[hasNorm] / chBSub[hasNorm]
+    ratioNormNormList = ratioNormList * chBSubMean
 
     return ratioList, ratioNormList, ratioNormNormList, chBSubMean
 
 
-def normalizeValues(inList, analysisDir, outFileName, inHi=0, numBins=100):
+def sweepThresholds(pBSub, DNABSub, chBSub, ratio, repSpots, pThs, DNAThs,
+                    chThs, numBins=100, maxChunk=20000000):
+    """This program evaluates every combination of protein, DNA and chamber
+    thresholds at once on background subtracted values and ratios calculated
+    without thresholds.  A spot passes a combination if all three values are
+    at or above their thresholds (as backgroundSubtract with nanF set).
+
+    It returns a dictionary of (pTh, DNATh, chTh) arrays: the number of
+    passing spots (numSpots), the number of oligos whose first two
+    replicates both pass (numPairs), the Pearson correlation of those
+    replicates' ratios (repCorr), the mean and standard deviation of the
+    passing ratios, and the Gaussian fit that normalizeValues would make to
+    the passing ratios (fitAmp, fitMean, fitStd)."""
+
+    pBSub = N.asarray(pBSub, float)
+    DNABSub = N.asarray(DNABSub, float)
+    chBSub = N.asarray(chBSub, float)
+    ratio = N.asarray(ratio, float)
+    pThs = N.asarray(pThs, float)
+    DNAThs = N.asarray(DNAThs, float)
+    chThs = N.asarray(chThs, float)
+
+    # NaN compares as False, so spots with a NaN value never pass
+    passP = pBSub[None, :] >= pThs[:, None]
+    passD = DNABSub[None, :] >= DNAThs[:, None]
+    passC = chBSub[None, :] >= chThs[:, None]
+
+    hasRatio = ~N.isnan(ratio)
+    cleanRatio = N.where(hasRatio, ratio, 0)
+
+    # oligos with at least two replicate spots
+    repSpots = repSpots[(repSpots[:, 0] >= 0) & (repSpots[:, 1] >= 0)]
+    rep0, rep1 = repSpots[:, 0], repSpots[:, 1]
+    x, y = cleanRatio[rep0], cleanRatio[rep1]
+    pairOk = hasRatio[rep0] & hasRatio[rep1]
+
+    shape = (len(pThs), len(DNAThs), len(chThs))
+    sweepD = dict((name, N.zeros(shape)) for name in
+                  ['numSpots', 'numPairs', 'repCorr', 'ratioMean', 'ratioStd'])
+    histStack = N.zeros(shape + (numBins,))
+    binCenters = N.zeros(shape + (numBins,))
+
+    # evaluate a block of protein thresholds at a time to bound memory use
+    chunk = max(1, maxChunk // max(1, len(DNAThs)*len(chThs)*len(ratio)))
+    for start in range(0, len(pThs), chunk):
+        stop = min(start + chunk, len(pThs))
+        passAll = (passP[start:stop, None, None, :] &
+                   passD[None, :, None, :] & passC[None, None, :, :])
+        sweepD['numSpots'][start:stop] = N.count_nonzero(passAll, axis=-1)
+
+        # mean and standard deviation of the passing ratios
+        w = passAll & hasRatio
+        wf = w.astype(float)
+        count = wf.sum(-1)
+        with N.errstate(invalid='ignore', divide='ignore'):
+            mean = N.dot(wf, cleanRatio) / count
+            std = N.sqrt(N.maximum(N.dot(wf, cleanRatio**2) / count - mean**2,
+                                   0))
+        sweepD['ratioMean'][start:stop] = mean
+        sweepD['ratioStd'][start:stop] = std
+
+        # replicate correlation from the pair sums
+        v = (passAll[..., rep0] & passAll[..., rep1] & pairOk).astype(float)
+        n = v.sum(-1)
+        sx, sy = N.dot(v, x), N.dot(v, y)
+        sxx, syy, sxy = N.dot(v, x*x), N.dot(v, y*y), N.dot(v, x*y)
+        with N.errstate(invalid='ignore', divide='ignore'):
+            corr = (n*sxy - sx*sy) / N.sqrt((n*sxx - sx**2)*(n*syy - sy**2))
+        sweepD['numPairs'][start:stop] = n
+        sweepD['repCorr'][start:stop] = corr
+
+        # histogram the passing ratios over +/- 3 standard deviations, as
+        # normalizeValues does, all combinations of the block at once
+        histStack[start:stop], binCenters[start:stop] = \
+            fitUtils.histogramStack(cleanRatio, numBins, -3*std, 3*std,
+                                    mask=w)
+
+    # fit a Gaussian to every histogram at once (no figures are made)
+    fitAmp, fitMean, fitStd = fitUtils.gaussianFitStack(
+        histStack.reshape(-1, numBins), binCenters.reshape(-1, numBins))
+    noSpread = ~(sweepD['ratioStd'] > 0)
+    for name, fit in [('fitAmp', fitAmp), ('fitMean', fitMean),
+                      ('fitStd', fitStd)]:
+        sweepD[name] = fit.reshape(shape)
+        sweepD[name][noSpread] = N.nan
+
+    return sweepD
+
+
+# ways of finding the center that normalizeValues subtracts
+NORMALIZATION_METHODS = ['gaussian', 'median', 'trimmed', 'kde', 'gmm']
+
+
+def normalizeValues(inList, analysisDir, outFileName, inHi=0, numBins=100,
+                    method='gaussian'):
     """This program normalizes values so that they are centered
-    around zero using python least squares minimization."""
+    around zero.  The center is found by method:
+
+        gaussian    least squares Gaussian fit to a +/- 3 sigma histogram
+        median      median (width from the median absolute deviation)
+        trimmed     mean of the values within the 10th-90th percentiles
+        kde         mode of a kernel density estimate on a fixed grid
+        gmm         mean of the main component of a two Gaussian mixture
 
-    outFileName = analysisDir+outFileName
-    cleanL = []
-    for a in inList:
-        if not N.isnan(a):
-            cleanL.append(a)
+    A figure of the fit (see fitUtils.normalizationFit) is saved to
+    analysisDir+outFileName unless analysisDir is None."""
 
-    inHi = 3*N.std(cleanL)
-    inLo = -inHi
+    values = N.asarray(inList, float)
+    if analysisDir is not None:
+        outFileName = analysisDir+outFileName
+    else:
+        outFileName = None
 
-    fitParams = fitUtils.gaussianFit(cleanL, numBins=numBins,
-                                     figFileName=outFileName, loBound=inLo,
-                                     hiBound=inHi)
-    rFitMean, rFitStd = fitParams[1], fitParams[2]
+    center = fitUtils.normalizationFit(values, numBins=numBins, method=method,
+                                       figFileName=outFileName)[1]
 
-    normL = []
-    for a in inList:
-        if not N.isnan(a):
-            normL.append(a-rFitMean)
-        else:
-            normL.append(N.nan)
+    # NaN values stay NaN
+    normL = values - center
 
     return normL
 
@@ -292,84 +462,134 @@ def normalizeValues(inList, analysisDir, outFileName, inHi=0, numBins=100):
 def normalizeMaxValue(inList):
     """This program values so that the maximum is 1."""
 
-    normList = []
-    maxVal = 0
-    for n in inList:
-        if not N.isnan(n) and n > maxVal:
-            maxVal = n
-    for n in range(0, len(inList)):
-        normList.append(float(inList[n])/maxVal)
-    return normList
+    values = N.asarray(inList, float)
+    maxVal = N.max(values[values > 0], initial=0)
+
+    return values / maxVal
 
 
 def calcNumOligos(spot2OligoFileName):
     """This program determines the number of oligos in an experiment
     using the spot2oligo file."""
 
-    oligoD = makeSpot2OligoDict(spot2OligoFileName)
-
-    # determine the number of oligos
-    numOligoD = {}
-    for item in oligoD:
-        if oligoD[item] in numOligoD:
-            pass
-        else:
-            if oligoD[item] == 'EMPTY':
-                pass
-            else:
-                numOligoD[oligoD[item]] = 1
-    numOligos = len(numOligoD) - 1
-
-    return numOligos
+    return spotLayout.loadSpotLayout(spot2OligoFileName).numOligos
 
 
 def calcNumSpotsPerOligo(spot2OligoFileName):
     """This program determines the number of replicates in an experiment
     using the spot2oligo file."""
 
-    oligoD = makeSpot2OligoDict(spot2OligoFileName)
-    numSpots = 0
+    return spotLayout.loadSpotLayout(spot2OligoFileName).numSpotsPerOligo
+
+
+def oligoSlots(layout, colList, rowList):
+    """This program finds where each spot goes in an oligo x replicate array:
+    it returns the indices of the spots that have a slot, with the oligo row
+    and replicate column of each.  Empty spots are skipped, replicates of each
+    oligo are numbered in the order the spots are given, and Oligo_0 ends up
+    in the last row."""
+
+    spotOligos = layout.oligoIndex(colList, rowList)
+    spots = N.flatnonzero(spotOligos >= 0)
+    spots = spots[layout.oligoNums[spotOligos[spots]] >= 0]
+    oligoIndex = layout.oligoNums[spotOligos[spots]]-1
+    arrayIndex = spotLayout.replicateIndex(spotOligos[spots])
 
-    for item in oligoD:
-        if oligoD[item] == 'Oligo_1':
-            numSpots = numSpots + 1
+    keep = arrayIndex < layout.numSpotsPerOligo
+    return spots[keep], oligoIndex[keep], arrayIndex[keep]
 
-    return numSpots
+
+def dataTensor(spot2OligoFileName, colList, rowList, itemLists):
+    """This program creates a (field, oligo, replicate) array of the data in
+    each list of itemLists, placing every field with a single scatter."""
+
+    layout = spotLayout.loadSpotLayout(spot2OligoFileName)
+    dimensions = (len(itemLists), layout.numOligos+1, layout.numSpotsPerOligo)
+    outArray = N.full(dimensions, N.nan)
+
+    spots, oligoIndex, arrayIndex = oligoSlots(layout, colList, rowList)
+    items = N.array([N.asarray(itemList, float) for itemList in itemLists])
+    outArray[:, oligoIndex, arrayIndex] = items[:, spots]
+
+    return outArray
 
 
 def dataArray(spot2OligoFileName, colList, rowList, itemList):
     """This program creates an array of the data in itemList
     with each row representing data from a single oligo."""
 
-    oligoD = makeSpot2OligoDict(spot2OligoFileName)
-    numOligos = calcNumOligos(spot2OligoFileName)+1
-    numSpotsPerOligo = calcNumSpotsPerOligo(spot2OligoFileName)
+    return dataTensor(spot2OligoFileName, colList, rowList, [itemList])[0]
+
 
-    dimensions = (numOligos, numSpotsPerOligo)
-    outArray = N.zeros(dimensions, float)
+# fields of each replicate in the per-oligo store, in the column order of the
+# legacy Oligo_<n>.dat files
+OLIGO_STORE_FIELDS = ['pBSub', 'DNAN', 'rNN', 'chBSub', 'Row', 'Col']
 
-    # Correct data array so that values start as NaN
+
+def writeOligoStore(fileName, fieldArrays):
+    """This program saves (oligo, replicate) arrays of the fields in
+    OLIGO_STORE_FIELDS, laid out as dataTensor, to a single .npy file of
+    records.  Row n holds the replicates of Oligo_<n+1>."""
+
+    dtype = [(name, N.float64) for name in OLIGO_STORE_FIELDS]
+    records = N.empty(fieldArrays[0].shape, dtype)
+    for n in range(0, len(OLIGO_STORE_FIELDS)):
+        records[OLIGO_STORE_FIELDS[n]] = fieldArrays[n]
+
+    # replace the store only once it is completely written
+    outFile = fileIOUtils.openAtomic(fileName, 'wb')
+    N.save(outFile, records)
+    outFile.close()
+
+
+def loadOligoStore(fileName, mmapFlag=1):
+    """This program opens a per-oligo store, memory-mapped unless mmapFlag is
+    0.  store[n - 1] holds the replicates of Oligo_<n> (e.g.
+    store[n - 1]['rNN']), read without touching the other oligos."""
+
+    return N.load(fileName, mmap_mode='r' if mmapFlag else None)
+
+
+def exportOligoDatFiles(store, textDir, numOligos=None):
+    """This program writes the legacy Oligo_<n>.dat text files of a per-oligo
+    store (or of the store saved in the file named store) to textDir."""
+
+    if isinstance(store, str):
+        store = loadOligoStore(store)
+    if numOligos is None:
+        numOligos = len(store)
+    repNums = [str(m + 1) for m in range(0, store.shape[1])]
     for n in range(0, numOligos):
-        for m in range(0, numSpotsPerOligo):
-            outArray[n][m] = N.NaN
-
-    repIndexD = {}
-    for n in range(0, len(itemList)):
-        spotIndex = str(colList[n])+"."+str(rowList[n])
-        oligo = oligoD[spotIndex]
-        if oligo == 'Empty' or oligo == 'EMPTY':
-            pass
-        else:
-            oligoIndex = int(oligo.split("_")[1].split(".")[0])-1
-            if oligo in repIndexD:
-                arrayIndex = repIndexD[oligo]
-                repIndexD[oligo] = (repIndexD[oligo] + 1)
-            else:
-                arrayIndex = 0
-                repIndexD[oligo] = 1
-
-        if arrayIndex < numSpotsPerOligo:
-            outArray[oligoIndex][arrayIndex] = itemList[n]
+        formatted = [repNums] + [formatColumn(store[n][name])
+                                 for name in OLIGO_STORE_FIELDS]
+        fileIOUtils.writeFile(
+            textDir + "Oligo_" + str(n + 1) + ".dat",
+            '#Rep\t' + '\t'.join(OLIGO_STORE_FIELDS) + '\n' +
+            ''.join('\t'.join(row) + '\n' for row in zip(*formatted)))
+
+
+def replicateSpots(spot2OligoFileName, colList, rowList):
+    """This program creates an (oligo, replicate) array of the index of the
+    spot in each slot (-1 for empty slots), laid out as dataTensor."""
+
+    layout = spotLayout.loadSpotLayout(spot2OligoFileName)
+    outArray = N.full((layout.numOligos+1, layout.numSpotsPerOligo), -1,
+                      N.int64)
+
+    spots, oligoIndex, arrayIndex = oligoSlots(layout, colList, rowList)
+    outArray[oligoIndex, arrayIndex] = spots
+
+    return outArray
+
+
+def gridArray(colList, rowList, itemLists, dimensions):
+    """This program places each list of itemLists onto the (spotsPerCol,
+    numCols) grid of the chip with a single scatter and returns a (field,
+    row, col) array.  Positions without a spot are left at zero."""
+
+    outArray = N.zeros((len(itemLists),) + tuple(dimensions))
+    items = N.array([N.asarray(itemList, float) for itemList in itemLists])
+    outArray[:, N.asarray(rowList) - 1, N.asarray(colList) - 1] = items
 
     return outArray
 
@@ -378,36 +598,23 @@ def determineDimensions(concatFileName):
     """This program reads in a concat file and automatically determines
     the number of spots in each column."""
 
-    concatFile = open(concatFileName, 'r')
-    spotsPerCol, numCols = 1, 1
-
-    lineIndex = 0
-    for line in concatFile:
-        lineIndex = lineIndex + 1
-        if lineIndex == 1:
-            pass
-        else:
-            tempList = line.split('\t')
-            currCol = int(tempList[3])
-            currSpot = int(tempList[4])
-            if currSpot > spotsPerCol:
-                spotsPerCol = currSpot
-            if currCol > numCols:
-                numCols = currCol
+    chip = loadConcatFile(concatFileName)
 
-    return numCols, spotsPerCol
+    return chip.numCols, chip.spotsPerCol
 
 
 def outputInfoFromConcatFile(concatFileName, spot2OligoFileName, pTh=100,
                              DNATh=1, chTh=1, nanFlag=0):
+    """This program reads a concat file and returns a ChipData object with the
+    flagged spots set to NaN and the background subtracted values, ratios and
+    oligo numbers filled in."""
 
-    # get lists from concat file
-    blocks, oRows, oCols, rows, cols, dia, flags, pFL, dFL, pBL, dBL, cFL = \
-        concatFileToLists(concatFileName)
+    # get arrays from concat file
+    chip = loadConcatFile(concatFileName)
 
     # deal with flagged spots
-    flags, pFg, DNAFg, pBg, DNABg, chFg = zeroFlaggedSpots(flags, pFL, dFL,
-                                                           pBL, dBL, cFL)
+    flags, pFg, DNAFg, pBg, DNABg, chFg = zeroFlaggedSpots(
+        chip.flag, chip.pFg, chip.DNAFg, chip.pBg, chip.DNABg, chip.chFg)
 
     # create pBSub, DNABSub, and chBSub lists
     pBSub, DNABSub, chBSub = backgroundSubtract(pFg, pBg, DNAFg, DNABg,
@@ -418,34 +625,58 @@ def outputInfoFromConcatFile(concatFileName, spot2OligoFileName, pTh=100,
     # create ratio list
     ratio = calculateRatios(pBSub, DNABSub, chBSub)[0]
 
+    chip = chip.replace(pFg=pFg, DNAFg=DNAFg, pBg=pBg, DNABg=DNABg, chFg=chFg)
+    return annotateChip(chip, pBSub, DNABSub, chBSub, ratio,
+                        spot2OligoFileName)
+
+
+def annotateChip(chip, pBSub, DNABSub, chBSub, ratio, spot2OligoFileName):
+    """This program returns a copy of the chip with the background subtracted
+    values and ratios filled in, along with the ratios normalized to the
+    chamber intensity and the oligo number of each spot."""
+
     # create normalized ratio list (just in case of printing problems)
-    ratioNorm = []
-    for n in range(0, len(ratio)):
-        if chBSub[n] > 100:
-            currRatioNorm = float(ratio[n])/float(chBSub[n])
-        else:
-            currRatioNorm = N.NaN
-        ratioNorm.append(currRatioNorm)
-
-    # create dictionaries linking spot index to oligo name and dilution
-    oligoD = makeSpot2OligoDict(spot2OligoFileName)
-
-    # create list of oligo numbers
-    oligoNum = []
-    for n in range(0, len(rows)):
-        curRow = rows[n]
-        curCol = cols[n]
-        spotID = str(curCol)+'.'+str(curRow)
-        if spotID in oligoD:
-            oligo = oligoD[spotID]
-        else:
-            print(spotID)
-            print("That key is not in the dictionary!")
-            oligo = 'EMPTY'
-        oligoNum.append(oligo.split("_")[1])
-
-    return [blocks, oRows, oCols, rows, cols, flags, pFg, DNAFg, pBg, DNABg,
-            chFg, pBSub, DNABSub, chBSub, ratio, ratioNorm, oligoNum]
+    ratioNorm = N.full(len(ratio), N.nan)
+    brightCh = chBSub > 100
+    ratioNorm[brightCh] = ratio[brightCh] / chBSub[brightCh]
+
+    # look up the oligo number of each spot
+    layout = spotLayout.loadSpotLayout(spot2OligoFileName)
+    spotOligos = layout.oligoIndex(chip.col, chip.row)
+    for n in N.flatnonzero(spotOligos < 0):
+        print(str(chip.col[n])+'.'+str(chip.row[n]))
+        print("That key is not in the dictionary!")
+    oligoNames = N.append(layout.names, 'EMPTY')
+    oligoNum = N.array([name.split("_")[-1]
+                        for name in oligoNames])[spotOligos]
+
+    return chip.replace(pBSub=pBSub, DNABSub=DNABSub, chBSub=chBSub,
+                        ratio=ratio, ratioNorm=ratioNorm, oligoNum=oligoNum)
+
+
+def seqFileColumns(seqFileName):
+    """This program reads a file of oligo numbers and sequences into arrays
+    of oligo numbers, sequences and truncated sequences (without the common
+    ends), in the form saved to the data cache."""
+
+    seqFile = fileIOUtils.openFile(seqFileName, 'r')
+    oligoNums, seqs = [], []
+    for line in seqFile:
+        tempList = line.split("\t")
+        oligoNums.append(tempList[0])
+        seqs.append(tempList[1].strip())
+    seqFile.close()
+
+    truncSeqs = [seq[3:-15] for seq in seqs]
+
+    return (['OligoNum', 'Seq', 'TruncSeq'],
+            [N.array(oligoNums, str), N.array(seqs, str),
+             N.array(truncSeqs, str)], {})
+
+
+# oligo sequence dictionaries, keyed by file path and truncFlag and checked
+# against the file's mtime
+_seqDictCache = {}
 
 
 def createDictFromSeqFile(seqFileName, truncFlag=0):
@@ -453,13 +684,75 @@ def createDictFromSeqFile(seqFileName, truncFlag=0):
     This subroutine creates a dictionary from oligo number and sequence data.
     """
 
-    seqFile = open(seqFileName, 'r')
+    key = (os.path.abspath(seqFileName), truncFlag)
+    mtime = os.path.getmtime(seqFileName)
+    if key in _seqDictCache and _seqDictCache[key][0] == mtime:
+        return _seqDictCache[key][1]
+
+    columnD = fileIOUtils.loadCachedColumns(seqFileName, 'library',
+                                            seqFileColumns)[0]
+    seqs = columnD['Seq'] if truncFlag == 0 else columnD['TruncSeq']
+
     seqDict = {'0': ''}
-    for line in seqFile:
-        tempList = line.split("\t")
-        if truncFlag == 0:
-            seqDict[tempList[0]] = tempList[1].strip()
-        else:
-            seqDict[tempList[0]] = tempList[1].strip()[3:-15]
+    seqDict.update(zip(columnD['OligoNum'].tolist(), seqs.tolist()))
 
+    _seqDictCache[key] = (mtime, seqDict)
     return seqDict
+
+
+# columns of a processed concat file (see processConcat_PR8.processChip)
+PROCESSED_COLUMNS = ['Block', 'OrigRow', 'OrigCol', 'Row', 'Col', 'Flag',
+                     'pFg', 'DNAFg', 'pBg', 'DNABg', 'chFg', 'pBSub',
+                     'DNABSub', 'chBSub', 'Ratio', 'RatioNorm', 'OligoNum',
+                     'OligoSeq', 'DNAN', 'rN', 'rNN', 'ZScore', 'pVal', 'qVal',
+                     'OligoPVal']
+
+
+def formatColumn(column, precision=None):
+    """This program formats a whole column as strings.  Floats are written
+    in their shortest exact form, or with precision significant digits if
+    it is given."""
+
+    column = N.asarray(column)
+    if column.dtype.kind == 'f' and precision is not None:
+        return list(map(('%.' + str(precision) + 'g').__mod__,
+                        column.tolist()))
+    return list(map(str, column.tolist()))
+
+
+def writeProcessedFile(fileName, columns, precision=None, storeF=0):
+    """This program writes the columns of a processed concat file (in the
+    order of PROCESSED_COLUMNS) as a tab-delimited file, formatting each
+    column at once and writing the file in one go.  If storeF is set, the
+    columns are also saved as a column store alongside the file."""
+
+    formatted = [formatColumn(column, precision) for column in columns]
+    lines = ['\t'.join(PROCESSED_COLUMNS)]
+    lines.extend(map('\t'.join, zip(*formatted)))
+    fileIOUtils.writeFile(fileName, '\n'.join(lines) + '\n')
+
+    if storeF != 0:
+        fileIOUtils.writeColumnStore(
+            fileIOUtils.columnStoreName(fileName), PROCESSED_COLUMNS,
+            [N.asarray(column) for column in columns])
+
+
+def loadProcessedColumns(fileName, columnNames):
+    """This program reads some columns of a processed concat file into a
+    dictionary of arrays.  A column store saved alongside the file is
+    memory-mapped instead of parsing the text, in which case the columns
+    keep their types; columns parsed from text are strings."""
+
+    storeName = fileIOUtils.findColumnStore(fileName)
+    if storeName is not None:
+        columnD = fileIOUtils.readColumnStore(storeName)[0]
+        return dict((name, columnD[name]) for name in columnNames)
+
+    inFile = fileIOUtils.openFile(fileName, 'r')
+    data = N.loadtxt(inFile, dtype=str, delimiter='\t', skiprows=1,
+                     usecols=[PROCESSED_COLUMNS.index(name)
+                              for name in columnNames],
+                     ndmin=2, comments=None)
+    inFile.close()
+    return dict((columnNames[n], data[:, n])
+                for n in range(0, len(columnNames)))
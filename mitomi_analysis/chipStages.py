@@ -0,0 +1,358 @@
+import os
+import json
+import hashlib
+import zipfile
+import numpy as N
+from . import chipSingleconcUtils
+from . import fitUtils
+from . import statsUtils
+from . import spotLayout
+from . import fileIOUtils
+from .chipData import ChipData
+
+# version of the stage results kept in the stage cache; bump it whenever a
+# stage changes what it computes so that stale results are not read
+STAGE_CACHE_VERSION = 7
+
+# directory (next to the concat file) holding the stage cache
+STAGE_CACHE_DIR = '.mitomi_cache'
+
+# chip fields whose normalization fits are bootstrapped
+BOOTSTRAP_CHANNELS = ['DNABSub', 'pBSub', 'ratio']
+
+# chip fields that are normalized, with the names of the normalized values
+NORMALIZED_CHANNELS = [('DNABSub', 'DNAN'), ('pBSub', 'pN'), ('ratio', 'rN')]
+
+# normalized values checked by the zscore stage, with the names of their fits
+CHECKED_VALUES = [('dParams', 'DNAN'), ('pParams', 'pN'), ('rParams', 'rNN')]
+
+
+class ChipStages(object):
+    """This class runs the processing stages of a single chip on demand:
+
+        load -> flag -> bgsub -> ratios -> normalize -> zscore
+                                        -> bootstrap
+
+    Each stage is computed the first time it is asked for with a given set of
+    parameters and kept, so analyses of the same chip (e.g. chip-analysis and
+    process) only compute the stages they share once.
+
+    If cacheFlag is set, stage results are also saved in a stage cache next
+    to the concat file, keyed by the contents of the input files and the
+    parameters of the stage, so a later run with different thresholds only
+    recomputes the stages those thresholds affect.  A damaged or unreadable
+    cache entry is simply recomputed.  Entries are never removed; deleting
+    the cache directory clears it."""
+
+    def __init__(self, concatFileName, spot2OligoFileName, cacheFlag=0):
+
+        self.concatFileName = concatFileName
+        self.spot2OligoFileName = spot2OligoFileName
+        self.results = {}
+        self.cacheDir = None
+        self.inputHashes = {}
+        if cacheFlag != 0:
+            self.cacheDir = os.path.join(
+                os.path.dirname(os.path.abspath(concatFileName)),
+                STAGE_CACHE_DIR)
+
+    def runStage(self, name, params, compute):
+        """This program returns the result of a stage, computing it with
+        compute() if it has not been computed for these parameters yet."""
+
+        key = (name,) + tuple(params)
+        if key in self.results:
+            return self.results[key]
+
+        result = None
+        if self.cacheDir is not None:
+            cacheFileName = self.cacheFileName(key)
+            if os.path.isfile(cacheFileName):
+                try:
+                    result = readStageResult(cacheFileName)
+                except (OSError, ValueError, KeyError, EOFError,
+                        zipfile.BadZipFile):
+                    # a damaged entry is recomputed and written again
+                    result = None
+        if result is None:
+            result = compute()
+            if self.cacheDir is not None:
+                try:
+                    fileIOUtils.createNewDir(self.cacheDir)
+                    writeStageResult(cacheFileName, result)
+                except OSError:
+                    # an unwritable cache only costs the stage next time
+                    pass
+
+        self.results[key] = result
+        return result
+
+    def inputHash(self, fileName):
+
+        if fileName not in self.inputHashes:
+            self.inputHashes[fileName] = fileIOUtils.fileHash(fileName)
+        return self.inputHashes[fileName]
+
+    def layoutHash(self):
+        """This program returns a digest of the spot2oligo file, for the
+        parameters of the stages that depend on it."""
+
+        return self.inputHash(self.spot2OligoFileName)
+
+    def cacheFileName(self, key):
+
+        keyString = json.dumps([STAGE_CACHE_VERSION,
+                                self.inputHash(self.concatFileName)] +
+                               list(key))
+        digest = hashlib.sha1(keyString.encode()).hexdigest()
+        return os.path.join(self.cacheDir, key[0] + '-' + digest + '.npz')
+
+    def load(self):
+        """This program returns the ChipData read from the concat file."""
+
+        return self.runStage('load', (), lambda: (
+            chipSingleconcUtils.loadConcatFile(self.concatFileName)))
+
+    def flag(self):
+        """This program returns the chip with flagged spots set to NaN."""
+
+        def compute():
+            chip = self.load()
+            flags, pFg, DNAFg, pBg, DNABg, chFg = \
+                chipSingleconcUtils.zeroFlaggedSpots(
+                    chip.flag, chip.pFg, chip.DNAFg, chip.pBg, chip.DNABg,
+                    chip.chFg)
+            return chip.replace(pFg=pFg, DNAFg=DNAFg, pBg=pBg, DNABg=DNABg,
+                                chFg=chFg)
+
+        return self.runStage('flag', (), compute)
+
+    def bgsub(self, pTh, DNATh, chTh, nanFlag, flagged=1):
+        """This program returns the background subtracted pBSub, DNABSub and
+        chBSub values, from the flagged chip or (if flagged is 0) the raw
+        one.  The DNA background is used for the chamber."""
+
+        params = bgsubParams(pTh, DNATh, chTh, nanFlag, flagged)
+
+        def compute():
+            chip = self.flag() if flagged else self.load()
+            return chipSingleconcUtils.backgroundSubtract(
+                chip.pFg, chip.pBg, chip.DNAFg, chip.DNABg, chip.chFg,
+                chip.DNABg, pTh=pTh, dTh=DNATh, cTh=chTh, nanF=nanFlag)
+
+        return self.runStage('bgsub', params, compute)
+
+    def ratios(self, pTh, DNATh, chTh, nanFlag, flagged=1):
+        """This program returns the output of calculateRatios for the
+        background subtracted values."""
+
+        params = bgsubParams(pTh, DNATh, chTh, nanFlag, flagged)
+        return self.runStage('ratios', params, lambda: (
+            chipSingleconcUtils.calculateRatios(
+                *self.bgsub(pTh, DNATh, chTh, nanFlag, flagged))))
+
+    def processed(self, pTh, DNATh, chTh, nanFlag):
+        """This program returns the flagged chip with the background
+        subtracted values, ratios and oligo numbers filled in (as
+        outputInfoFromConcatFile)."""
+
+        params = (bgsubParams(pTh, DNATh, chTh, nanFlag, 1) +
+                  (self.layoutHash(),))
+
+        def compute():
+            pBSub, DNABSub, chBSub = self.bgsub(pTh, DNATh, chTh, nanFlag)
+            ratio = self.ratios(pTh, DNATh, chTh, nanFlag)[0]
+            return chipSingleconcUtils.annotateChip(
+                self.flag(), pBSub, DNABSub, chBSub, ratio,
+                self.spot2OligoFileName)
+
+        return self.runStage('processed', params, compute)
+
+    def normalize(self, pTh, DNATh, chTh, nanFlag, figDir, method='gaussian'):
+        """This program returns a dictionary of the DNABSub, pBSub and ratio
+        values centered on zero (DNAN, pN, rN), the centered ratios scaled
+        to a maximum of 1 (rNN), and the fits (see fitUtils.normalizationFit)
+        whose centers were subtracted (DNABSubParams, pBSubParams,
+        ratioParams), using the normalizeValues method given.  Figures of
+        the fits are saved in figDir, if it is not None; they are drawn from
+        the fits every time, so they do not depend on the stage cache."""
+
+        params = (bgsubParams(pTh, DNATh, chTh, nanFlag, 1) +
+                  (self.layoutHash(), method))
+
+        def compute():
+            chip = self.processed(pTh, DNATh, chTh, nanFlag)
+            normD = {}
+            for name, normName in NORMALIZED_CHANNELS:
+                fitParams = N.array(fitUtils.normalizationFit(
+                    chip[name], numBins=100, method=method))
+                # NaN values stay NaN
+                normD[normName] = N.asarray(chip[name], float) - fitParams[1]
+                normD[name + 'Params'] = fitParams
+            normD['rNN'] = chipSingleconcUtils.normalizeMaxValue(normD['rN'])
+            return normD
+
+        normD = self.runStage('normalize', params, compute)
+
+        if figDir is not None:
+            chip = self.processed(pTh, DNATh, chTh, nanFlag)
+            for name, normName in NORMALIZED_CHANNELS:
+                fitUtils.plotNormalizationFit(chip[name], 100,
+                                              normD[name + 'Params'],
+                                              figDir + name + '.png')
+
+        return normD
+
+    def bootstrap(self, pTh, DNATh, chTh, nanFlag, numResamples, seed=0,
+                  numWorkers=1, method='gaussian'):
+        """This program returns a dictionary with, for the DNABSub, pBSub and
+        ratio values, the mean and width of the normalization fit made with
+        the normalizeValues method given (see fitUtils.normalizationFit) and
+        their 95% bootstrap confidence intervals, as an array of fitMean,
+        fitMeanLo, fitMeanHi, fitStd, fitStdLo, fitStdHi."""
+
+        params = (bgsubParams(pTh, DNATh, chTh, nanFlag, 1) +
+                  (self.layoutHash(), numResamples, seed, method))
+
+        def compute():
+            chip = self.processed(pTh, DNATh, chTh, nanFlag)
+            bootD = {}
+            for name in BOOTSTRAP_CHANNELS:
+                fitParams = fitUtils.normalizationFit(chip[name], numBins=100,
+                                                      method=method)
+                meanCI, stdCI = fitUtils.bootstrapFit(
+                    chip[name], numBins=100, numResamples=numResamples,
+                    seed=seed, numWorkers=numWorkers, method=method)
+                bootD[name] = N.array([fitParams[1], meanCI[0], meanCI[1],
+                                       fitParams[2], stdCI[0], stdCI[1]])
+            return bootD
+
+        return self.runStage('bootstrap', params, compute)
+
+    def zscore(self, pTh, DNATh, chTh, nanFlag, figDir, method='gaussian',
+               sides=1):
+        """This program checks the normalization by estimating the center and
+        width of the normalized values again with the normalizeValues method
+        given (see fitUtils.normalizationFit) and returns a dictionary of
+        the fit parameters and, for each rNN value, its z-score, its one- or
+        two-sided p-value (sides), the Benjamini-Hochberg q-value, and the
+        Fisher combined p-value of the replicate spots of its oligo
+        (oligoPVal).  Figures of the fits are drawn from them in
+        figDir/CheckFits/ if figDir is not None."""
+
+        params = (bgsubParams(pTh, DNATh, chTh, nanFlag, 1) +
+                  (self.layoutHash(), method, sides))
+
+        def compute():
+            normD = self.normalize(pTh, DNATh, chTh, nanFlag, None,
+                                   method=method)
+            # the centers and widths come from the same estimator as the
+            # normalization, so only the gaussian method uses the optimizer
+            zD = {}
+            for paramName, name in CHECKED_VALUES:
+                zD[paramName] = N.array(fitUtils.normalizationFit(
+                    normD[name], numBins=100, method=method))
+            rParams = zD['rParams']
+
+            zD['zScore'] = statsUtils.calcZScores(normD['rNN'], rParams[1],
+                                                  rParams[2])
+            zD['pVal'] = statsUtils.calcNormPValues(zD['zScore'], sides=sides)
+            zD['qVal'] = statsUtils.calcBHQValues(zD['pVal'])
+
+            # combine the p-values of the replicates of each oligo; empty
+            # spots and the empty chambers of Oligo_0 (not counted in
+            # numOligos) get NaN
+            chip = self.load()
+            layout = spotLayout.loadSpotLayout(self.spot2OligoFileName)
+            spotOligos = layout.oligoIndex(chip.col, chip.row)
+            spotOligos = N.where((spotOligos >= 0) &
+                                 (layout.oligoNums[spotOligos] > 0),
+                                 spotOligos, -1)
+            oligoPVals = statsUtils.calcFisherCombinedPValues(
+                zD['pVal'], spotOligos, len(layout.names))
+            zD['oligoPVal'] = N.where(spotOligos >= 0,
+                                      oligoPVals[spotOligos], N.nan)
+            return zD
+
+        zD = self.runStage('zscore', params, compute)
+
+        if figDir is not None:
+            normD = self.normalize(pTh, DNATh, chTh, nanFlag, None,
+                                   method=method)
+            checkDir = figDir + "CheckFits/"
+            fileIOUtils.createNewDir(checkDir)
+            for paramName, name in CHECKED_VALUES:
+                fitUtils.plotNormalizationFit(normD[name], 100, zD[paramName],
+                                              checkDir + name + '.png')
+
+        return zD
+
+
+def bgsubParams(pTh, DNATh, chTh, nanFlag, flagged):
+    """This program returns the parameters that the background subtraction
+    depends on; the thresholds only matter when nanFlag is set."""
+
+    if nanFlag == 0:
+        return (None, None, None, 0, flagged)
+    return (pTh, DNATh, chTh, nanFlag, flagged)
+
+
+def writeStageResult(fileName, result):
+    """This program saves the result of a stage (a ChipData object, or a tuple
+    or dictionary of arrays) to an .npz file, replacing the file only once it
+    is completely written."""
+
+    arrays = {}
+    if isinstance(result, ChipData):
+        arrays['kind'] = 'chip'
+        arrays['info'] = json.dumps(result.info())
+        for name, value in result.fields().items():
+            arrays['chip.' + name] = value
+    elif isinstance(result, tuple):
+        arrays['kind'] = 'tuple'
+        for n in range(0, len(result)):
+            arrays['item.' + str(n)] = result[n]
+    else:
+        arrays['kind'] = 'dict'
+        for name, value in result.items():
+            arrays['key.' + name] = value
+
+    outFile = fileIOUtils.openAtomic(fileName, 'wb')
+    N.savez(outFile, **arrays)
+    outFile.close()
+
+
+def readStageResult(fileName):
+    """This program reads a stage result saved by writeStageResult."""
+
+    npzFile = N.load(fileName)
+    arrays = dict((name, npzFile[name]) for name in npzFile.files)
+    npzFile.close()
+    for name in arrays:
+        if arrays[name].ndim == 0:
+            arrays[name] = arrays[name][()]
+
+    kind = str(arrays.pop('kind'))
+    if kind == 'chip':
+        info = json.loads(str(arrays.pop('info')))
+        return ChipData(info=info, **dict((name[5:], arrays[name])
+                                          for name in arrays))
+    elif kind == 'tuple':
+        return tuple(arrays['item.' + str(n)] for n in range(0, len(arrays)))
+    return dict((name[4:], arrays[name]) for name in arrays)
+
+
+# stages of the chips handled by this process, keyed by file names
+_chipStages = {}
+
+
+def getChipStages(concatFileName, spot2OligoFileName, cacheFlag=0):
+    """This program returns the ChipStages object for a chip, so that every
+    analysis of the chip in this process shares the computed stages."""
+
+    key = (os.path.abspath(concatFileName),
+           os.path.abspath(spot2OligoFileName), cacheFlag)
+    if key not in _chipStages:
+        _chipStages[key] = ChipStages(concatFileName, spot2OligoFileName,
+                                      cacheFlag=cacheFlag)
+    return _chipStages[key]
@@ -0,0 +1,76 @@
+import sys
+import os
+from getopt import getopt
+from . import chipSingleconcUtils
+from . import fileIOUtils
+
+
+HELP_STRING = """
+export-oligos
+
+This program writes the legacy text files Oligo_<n>.dat, one per oligo with
+the pBSub, DNAN, rNN, chBSub, row and column of each replicate, from the
+per-oligo store (OligoData.npy) saved by process.  Use it to get the text
+files of a chip that was processed without -l, without processing it again.
+
+     -h     print this help message
+     -i     per-oligo store filename (optional, default is
+            OligoAnalysis/OligoData.npy)
+     -o     directory for the text files (optional, default is TextFiles/
+            next to the store)
+     -n     number of oligos to write (optional, default is every oligo in
+            the store)
+
+Example:
+mitomi export-oligos -i chip1_Concat/OligoAnalysis/OligoData.npy
+"""
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    storeFileName = os.path.join("OligoAnalysis", "OligoData.npy")
+    textDir = ""
+    numOligos = None
+
+    try:
+        optlist, args = getopt(argv[1:], "hi:o:n:")
+    except:
+        print("")
+        print(HELP_STRING)
+        sys.exit(1)
+
+    for (opt, opt_arg) in optlist:
+        if opt == '-h':
+            print("")
+            print(HELP_STRING)
+            sys.exit(0)
+        elif opt == '-i':
+            storeFileName = opt_arg
+        elif opt == '-o':
+            textDir = opt_arg
+        elif opt == '-n':
+            numOligos = int(opt_arg)
+
+    if not os.path.isfile(storeFileName):
+        print("Cannot find the per-oligo store " + storeFileName)
+        print(HELP_STRING)
+        sys.exit(1)
+
+    if textDir == "":
+        textDir = os.path.join(os.path.dirname(storeFileName), "TextFiles")
+    # exportOligoDatFiles appends the file names to the directory
+    textDir = os.path.join(textDir, "")
+    fileIOUtils.createNewDir(textDir)
+
+    chipSingleconcUtils.exportOligoDatFiles(storeFileName, textDir,
+                                            numOligos=numOligos)
+    print("Oligo text files written to " + textDir)
+
+    return 0
+
+
+##############################################
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,35 @@
 import os
+import io
+import gzip
+import lzma
+import json
+import queue
+import hashlib
+import tempfile
+import threading
+import numpy as N
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# a column store is a directory holding one .npy file per column and a small
+# JSON header naming the columns
+COLUMN_STORE_EXT = '.npc'
+COLUMN_STORE_HEADER = 'header.json'
+
+# extensions of the compressed files that are read and written transparently
+COMPRESSION_EXTS = ['.gz', '.xz', '.zst']
+
+# the process umask, given to the temporary files of AtomicFile (mkstemp
+# creates them readable by the owner only)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# version of the data kept in the user cache directory; bump it whenever the
+# cached arrays change so that stale entries are not read
+DATA_CACHE_VERSION = 1
 
 
 def createNewDir(dirName):
@@ -6,7 +37,11 @@ def createNewDir(dirName):
     if os.path.isdir(dirName):
         pass
     else:
-        os.mkdir(dirName)
+        try:
+            os.mkdir(dirName)
+        except FileExistsError:
+            # made by another process in the meantime
+            pass
 
 
 def createNewSeqDir(dirName):
@@ -25,7 +60,7 @@ def createNewSeqDir(dirName):
 
 def fastaToDict(inFileName):
 
-    inFile = open(inFileName, 'r')
+    inFile = openFile(inFileName, 'r')
     outD = {}
     curSeq = ''
     lineIndex = 0
@@ -47,7 +82,7 @@ def fastaToDict(inFileName):
 
 def dictToFasta(outDict, outFileName):
 
-    outFile = open(outFileName, 'w')
+    outFile = openAtomic(outFileName, 'w')
     for item in outDict:
         outFile.write(">"+item+"\n")
         for n in range(0, (len(outDict[item])/60+1)):
@@ -57,7 +92,7 @@ def dictToFasta(outDict, outFileName):
 
 def fastaToDictMITOMI(inFileName):
 
-    inFile = open(inFileName, 'r')
+    inFile = openFile(inFileName, 'r')
     outD = {}
     curSeq = ''
     lineIndex = 0
@@ -79,7 +114,7 @@ def fastaToDictMITOMI(inFileName):
 
 def fileToList(inFileName):
 
-    inFile = open(inFileName, 'r')
+    inFile = openFile(inFileName, 'r')
     outList = []
     for line in inFile:
         outList.append(line.strip())
@@ -89,8 +124,9 @@ def fileToList(inFileName):
 
 def removeTabBeforeCarriageReturn(inFileName):
 
-    fIn = open(inFileName, 'r')
-    fOut = open(inFileName[:-4]+'_Clean.txt', 'w')
+    fIn = openFile(inFileName, 'r')
+    fOut = openAtomic(fileRoot(inFileName)+'_Clean.txt' +
+                      compressionExt(inFileName), 'w')
     for line in fIn:
         tempL = line.split('\t')
         for a in range(0, len(tempL)-2):
@@ -100,3 +136,409 @@ def removeTabBeforeCarriageReturn(inFileName):
         fOut.write(lastCol+'\n')
     fIn.close()
     fOut.close()
+
+
+class AtomicFile(io.FileIO):
+    """This class is a file opened for writing that only appears under its
+    name once it is closed: it is written to a temporary file of its own in
+    the same directory, which close() renames over fileName.  If the writing
+    fails (or the job is killed), fileName is left as it was."""
+
+    def __init__(self, fileName):
+
+        self.fileName = fileName
+        fd, self.tempFileName = tempfile.mkstemp(
+            suffix='.tmp', prefix=os.path.basename(fileName) + '.',
+            dir=os.path.dirname(fileName) or '.')
+        io.FileIO.__init__(self, fd, 'wb')
+        # set once there is a temporary file for discard() to remove
+        self.committed = False
+        os.chmod(self.tempFileName, 0o666 & ~_UMASK)
+
+    def close(self):
+
+        if not self.closed:
+            io.FileIO.close(self)
+            os.replace(self.tempFileName, self.fileName)
+            self.committed = True
+
+    def discard(self):
+        """This program abandons the file, removing the temporary file.  It
+        does nothing once close() has put the file in place."""
+
+        if getattr(self, 'committed', True):
+            return
+        if not self.closed:
+            io.FileIO.close(self)
+        if os.path.exists(self.tempFileName):
+            os.remove(self.tempFileName)
+
+    def __exit__(self, excType, excValue, traceback):
+
+        if excType is not None:
+            self.discard()
+        else:
+            self.close()
+
+    def __del__(self):
+
+        # a file that was never closed is incomplete
+        self.discard()
+
+
+def compressionExt(fileName):
+    """This program returns the compression extension of fileName (one of
+    COMPRESSION_EXTS), or '' if the file is not compressed."""
+
+    ext = os.path.splitext(fileName)[1].lower()
+    return ext if ext in COMPRESSION_EXTS else ''
+
+
+def fileRoot(fileName):
+    """This program returns fileName without its extension, dropping the
+    compression extension as well (chip_Concat.txt.gz gives chip_Concat)."""
+
+    if compressionExt(fileName) != '':
+        fileName = os.path.splitext(fileName)[0]
+    return os.path.splitext(fileName)[0]
+
+
+def zstdModule():
+
+    if zstandard is None:
+        raise ImportError("zstd (.zst) files need the zstandard package")
+    return zstandard
+
+
+def openFile(fileName, mode='r'):
+    """This program opens fileName for reading, or for writing through
+    openAtomic, in text or binary ('rb', 'wb') mode.  Files ending in .gz,
+    .xz or .zst (if the zstandard package is installed) are decompressed or
+    compressed as they are streamed, so the returned file can be handed
+    straight to N.loadtxt or N.savetxt."""
+
+    if 'r' not in mode:
+        return openAtomic(fileName, mode)
+
+    ext = compressionExt(fileName)
+    streamMode = 'rb' if 'b' in mode else 'rt'
+    if ext == '.gz':
+        return gzip.open(fileName, streamMode)
+    elif ext == '.xz':
+        return lzma.open(fileName, streamMode)
+    elif ext == '.zst':
+        return zstdModule().open(fileName, streamMode)
+    return open(fileName, mode)
+
+
+def compressStream(rawFile, ext):
+    """This program returns a stream that compresses what is written to it
+    into the binary file rawFile, in the format given by ext.  Closing the
+    stream leaves rawFile open."""
+
+    if ext == '.gz':
+        # the name and time are left out of the header, so the same data
+        # always compresses to the same file
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=6,
+                             fileobj=rawFile, mtime=0)
+    elif ext == '.xz':
+        return lzma.LZMAFile(rawFile, 'wb')
+    return zstdModule().ZstdCompressor().stream_writer(rawFile,
+                                                       closefd=False)
+
+
+def openAtomic(fileName, mode='w'):
+    """This program opens fileName for writing through an AtomicFile, in text
+    ('w') or binary ('wb') mode, compressing the data if fileName ends in a
+    compression extension (see openFile).  The file is put in place by
+    close()."""
+
+    ext = compressionExt(fileName)
+    if ext == '.zst':
+        zstdModule()
+    rawFile = AtomicFile(fileName)
+    if ext != '':
+        outFile = AtomicCompressedFile(rawFile, compressStream(rawFile, ext))
+    elif 'b' in mode:
+        return rawFile
+    else:
+        outFile = io.BufferedWriter(rawFile)
+    if 'b' in mode:
+        return outFile
+    return AtomicTextFile(outFile, rawFile)
+
+
+class AtomicCompressedFile(io.BufferedIOBase):
+    """This class is an AtomicFile written through a compressing stream."""
+
+    def __init__(self, rawFile, stream):
+
+        io.BufferedIOBase.__init__(self)
+        self.rawFile = rawFile
+        self.stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+
+        self.stream.write(data)
+        return len(data)
+
+    def flush(self):
+
+        if not self.stream.closed:
+            self.stream.flush()
+
+    def close(self):
+
+        if not self.closed:
+            self.stream.close()
+            self.rawFile.close()
+            io.BufferedIOBase.close(self)
+
+    def discard(self):
+
+        if self.rawFile.committed:
+            return
+        try:
+            self.stream.close()
+        except (OSError, ValueError):
+            pass
+        self.rawFile.discard()
+        io.BufferedIOBase.close(self)
+
+    def __exit__(self, excType, excValue, traceback):
+
+        if excType is not None:
+            self.discard()
+        else:
+            self.close()
+
+    def __del__(self):
+
+        if not self.closed:
+            self.discard()
+
+
+class AtomicTextFile(io.TextIOWrapper):
+    """This class is the text mode of AtomicFile, written through buffer."""
+
+    def __init__(self, buffer, rawFile):
+
+        io.TextIOWrapper.__init__(self, buffer, encoding='utf-8')
+        self.rawFile = rawFile
+
+    def discard(self):
+
+        if self.rawFile.committed:
+            return
+        if isinstance(self.buffer, AtomicCompressedFile):
+            self.buffer.discard()
+        self.rawFile.discard()
+
+    def __exit__(self, excType, excValue, traceback):
+
+        if excType is not None:
+            self.discard()
+        else:
+            self.close()
+
+    def __del__(self):
+
+        self.discard()
+
+
+def writeFile(fileName, contents):
+    """This program writes a string or bytes to fileName atomically."""
+
+    outFile = openAtomic(fileName, 'wb' if isinstance(contents, bytes)
+                         else 'w')
+    outFile.write(contents)
+    outFile.close()
+
+
+class OutputWriter(object):
+    """This class writes output files on a background thread, so that the
+    writing overlaps with the computing of later outputs.  submit() queues a
+    function that writes files (through openAtomic, so a job that is killed
+    never leaves a truncated output) and write() queues a whole file.  The
+    thread works through everything queued each time it wakes, so many small
+    files are written back to back.  close() waits for all queued writes and
+    raises the first error one of them hit."""
+
+    def __init__(self):
+
+        self.jobs = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, writeFunction, *args, **kwargs):
+
+        if self.thread is None:
+            raise ValueError("OutputWriter is closed")
+        self.jobs.put((writeFunction, args, kwargs))
+
+    def write(self, fileName, contents):
+
+        self.submit(writeFile, fileName, contents)
+
+    def run(self):
+
+        while True:
+            batch = [self.jobs.get()]
+            while not self.jobs.empty():
+                batch.append(self.jobs.get())
+            for job in batch:
+                if job is None:
+                    return
+                try:
+                    job[0](*job[1], **job[2])
+                except Exception as error:
+                    self.errors.append(error)
+
+    def close(self):
+
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+
+        if excType is None:
+            self.close()
+        else:
+            # finish the queued writes, but report the original error
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
+def columnStoreName(fileName):
+    """This program returns the name of the column store kept alongside a
+    tab-delimited file.  The compression extension of a compressed file is
+    kept (x_Concat.txt.gz gives x_Concat.gz.npc), so that it does not share
+    a store with the uncompressed file of the same name."""
+
+    return fileRoot(fileName) + compressionExt(fileName) + COLUMN_STORE_EXT
+
+
+def isColumnStore(fileName):
+
+    return os.path.isfile(os.path.join(fileName, COLUMN_STORE_HEADER))
+
+
+def findColumnStore(fileName):
+    """This program returns the column store to read in place of fileName:
+    fileName itself if it is a store, otherwise a store saved alongside it
+    that is at least as new as the text file, otherwise None."""
+
+    if isColumnStore(fileName):
+        return fileName
+    storeName = columnStoreName(fileName)
+    if isColumnStore(storeName):
+        headerName = os.path.join(storeName, COLUMN_STORE_HEADER)
+        if (not os.path.exists(fileName) or
+                os.path.getmtime(headerName) >= os.path.getmtime(fileName)):
+            return storeName
+    return None
+
+
+def writeColumnStore(storeName, columnNames, columns, header=None):
+    """This program writes a list of columns to a column store, with any extra
+    header information saved in the JSON header."""
+
+    createNewDir(storeName)
+    # the header is removed first and written last, so a partly rewritten
+    # store is never read
+    headerName = os.path.join(storeName, COLUMN_STORE_HEADER)
+    if os.path.exists(headerName):
+        os.remove(headerName)
+    for n in range(0, len(columnNames)):
+        columnFile = openAtomic(os.path.join(storeName,
+                                             columnNames[n] + '.npy'), 'wb')
+        N.save(columnFile, N.ascontiguousarray(columns[n]))
+        columnFile.close()
+
+    outHeader = dict(header or {})
+    outHeader['columns'] = list(columnNames)
+    outHeader['numRows'] = len(columns[0]) if len(columns) > 0 else 0
+    writeFile(headerName, json.dumps(outHeader, indent=1))
+
+
+def readColumnStore(storeName, mmapFlag=1):
+    """This program reads a column store, memory-mapping each column, and
+    returns a dictionary of columns and the header."""
+
+    headerFile = open(os.path.join(storeName, COLUMN_STORE_HEADER), 'r')
+    header = json.load(headerFile)
+    headerFile.close()
+
+    mmapMode = 'r' if mmapFlag else None
+    columns = {}
+    for name in header['columns']:
+        columns[name] = N.load(os.path.join(storeName, name + '.npy'),
+                               mmap_mode=mmapMode)
+
+    return columns, header
+
+
+def userCacheDir():
+    """This program returns the directory used to cache parsed data files."""
+
+    cacheRoot = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cacheRoot, 'mitomi_analysis')
+
+
+def fileHash(fileName):
+    """This program returns the SHA-1 digest of a file's contents, or of all
+    the files in a directory such as a column store."""
+
+    if os.path.isdir(fileName):
+        fileNames = [os.path.join(fileName, name)
+                     for name in sorted(os.listdir(fileName))]
+    else:
+        fileNames = [fileName]
+
+    sha = hashlib.sha1()
+    for name in fileNames:
+        inFile = open(name, 'rb')
+        for chunk in iter(lambda: inFile.read(1 << 20), b''):
+            sha.update(chunk)
+        inFile.close()
+    return sha.hexdigest()
+
+
+def loadCachedColumns(fileName, kind, buildColumns):
+    """This program returns the columns and header parsed from fileName by
+    buildColumns(fileName), which must return (columnNames, columns, header).
+    The result is saved as a column store in the user cache directory, keyed
+    by the kind of data and the file's contents, and memory-mapped from there
+    on later calls."""
+
+    storeName = os.path.join(userCacheDir(), '%s-v%d-%s%s' % (
+        kind, DATA_CACHE_VERSION, fileHash(fileName), COLUMN_STORE_EXT))
+    if isColumnStore(storeName):
+        return readColumnStore(storeName)
+
+    columnNames, columns, header = buildColumns(fileName)
+    try:
+        if not os.path.isdir(userCacheDir()):
+            os.makedirs(userCacheDir())
+        writeColumnStore(storeName, columnNames, columns, header)
+    except OSError:
+        # an unwritable cache only costs the parse next time
+        pass
+
+    header = dict(header)
+    header['columns'] = list(columnNames)
+    return dict(zip(columnNames, columns)), header
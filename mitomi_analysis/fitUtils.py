@@ -1,6 +1,7 @@
 import numpy as N
-from matplotlib import pylab as plt
+from concurrent.futures import ProcessPoolExecutor
 from scipy import optimize
+from scipy import special
 
 
 def gaussian(p, x):
@@ -12,12 +13,159 @@ def residualsG(p, y, x):
     return err
 
 
-def gaussianFit(data, numBins, figFileName, loBound=0, hiBound=0):
+def jacobianG(p, y, x):
+    """This program returns the derivatives of residualsG with respect to the
+    amplitude, mean and width, one row per point."""
 
-    cleanL = []
-    for a in data:
-        if not N.isnan(a):
-            cleanL.append(a)
+    z = (x-p[1])/p[2]
+    e = N.exp(-0.5*z**2)
+    return -N.column_stack([e, p[0]*e*z/p[2], p[0]*e*z**2/p[2]])
+
+
+def robustMoments(data):
+    """This program returns the median and the standard deviation estimated
+    from the median absolute deviation, which are not pulled around by
+    outliers the way the mean and standard deviation are.  For an (..., n)
+    array the moments of each row are returned."""
+
+    median = N.median(data, axis=-1)
+    width = 1.4826*N.median(N.abs(data - median[..., None]), axis=-1)
+    width = N.where(width == 0, N.std(data, axis=-1), width)[()]
+    return median, width
+
+
+def trimmedMean(data, trim=0.1):
+    """This program returns the mean and standard deviation of the values left
+    after dropping the lowest and highest trim fraction (of each row of an
+    (..., n) array).  The standard deviation is scaled up so that it
+    estimates the width of normally distributed data rather than that of
+    the trimmed core."""
+
+    sortedData = N.sort(data, axis=-1)
+    k = int(trim*sortedData.shape[-1])
+    core = sortedData[..., k:sortedData.shape[-1]-k]
+    width = N.std(core, axis=-1)
+    if trim > 0:
+        # variance of a standard normal truncated to its central 1-2*trim
+        a = special.ndtri(1 - trim)
+        coreVar = 1 - 2*a*N.exp(-0.5*a**2)/N.sqrt(2*N.pi)/(1 - 2*trim)
+        width = width/N.sqrt(coreVar)
+    return N.mean(core, axis=-1), width
+
+
+def kdeMode(data, numGrid=512, gridWidths=6):
+    """This program returns the mode of a Gaussian kernel density estimate
+    (bandwidth by Silverman's rule) and the robust width of the data, for
+    each row of an (..., n) array.  The density is evaluated on a fixed grid
+    of numGrid points spanning gridWidths robust widths either side of the
+    median, by binning the data on the grid and convolving with the kernel.
+    When the kernel would be wider than the grid, the density carries no
+    useful mode and the median is returned instead."""
+
+    data = N.asarray(data, float)
+    median, width = robustMoments(data)
+    q75, q25 = N.percentile(data, [75, 25], axis=-1)
+    std = N.std(data, axis=-1)
+    spread = N.where(q75 > q25, N.minimum(std, (q75 - q25)/1.34), std)
+    bandwidth = 0.9*spread*data.shape[-1]**-0.2
+
+    counts, grid = histogramStack(data, numGrid, median - gridWidths*width,
+                                  median + gridWidths*width)
+    step = 2*gridWidths*width/numGrid
+    with N.errstate(invalid='ignore', divide='ignore'):
+        kernelHalf = N.ceil(4*bandwidth/step)
+    useMedian = ((bandwidth == 0) | (width == 0) |
+                 ~(kernelHalf <= (numGrid - 1)//2))
+    kernelHalf = N.where(useMedian, 0, kernelHalf).astype(int)
+
+    # one kernel per row, padded to the widest, convolved by FFT
+    maxHalf = int(N.max(kernelHalf))
+    offsets = N.arange(-maxHalf, maxHalf+1)
+    with N.errstate(invalid='ignore', divide='ignore'):
+        kernel = N.exp(-0.5*(offsets*(step/bandwidth)[..., None])**2)
+    kernel = N.where(N.abs(offsets) <= kernelHalf[..., None], kernel, 0)
+    size = numGrid + 2*maxHalf
+    density = N.fft.irfft(N.fft.rfft(counts, size)*N.fft.rfft(kernel, size),
+                          size)[..., maxHalf:maxHalf+numGrid]
+    mode = N.take_along_axis(grid, N.argmax(density, axis=-1)[..., None],
+                             axis=-1)[..., 0]
+    return N.where(useMedian, median, mode)[()], width
+
+
+def gaussianMixtureFit(data, numIter=200, tol=1e-8, clipWidths=10):
+    """This program fits a mixture of two Gaussians by expectation
+    maximization and returns the mean and width of the component with the
+    larger weight, for each row of an (..., n) array (all rows are fitted
+    together).  Points more than clipWidths robust widths from the median
+    are left out, so that a few extreme values cannot claim a component.
+    The number of iterations is capped, so a fit that does not converge
+    still returns."""
+
+    data = N.asarray(data, float)
+    mean, width = robustMoments(data)
+    mean, width = N.asarray(mean), N.asarray(width)
+    fitted = width > 0
+    # fit in robust widths from the median; left out points are moved to the
+    # median and given no weight
+    x = (data - mean[..., None])/N.where(fitted, width, 1)[..., None]
+    keep = N.abs(x) <= clipWidths
+    x = N.where(keep, x, 0)
+    w = keep.astype(float)
+    count = w.sum(-1)
+    sumX = N.einsum('...n,...n->...', w, x)
+    sumX2 = N.einsum('...n,...n,...n->...', w, x, x)
+
+    mu = N.moveaxis(N.nanpercentile(N.where(keep, x, N.nan), [25, 75],
+                                    axis=-1), 0, -1)
+    var = N.var(x, axis=-1, where=keep)[..., None]*N.ones(2)
+    weight = N.full(mu.shape, 0.5)
+    lastLogL = N.full(width.shape, -N.inf)
+    active = fitted.copy()
+    with N.errstate(invalid='ignore', divide='ignore'):
+        for n in range(0, numIter):
+            if not N.any(active):
+                break
+            # E step: the log density of each component is a quadratic in x,
+            # so the responsibility of the second is the logistic of the
+            # difference of the two quadratics
+            c = -0.5/var
+            b = mu/var
+            a = N.log(weight) - 0.5*N.log(2*N.pi*var) - 0.5*mu**2/var
+            d = ((a[..., 1] - a[..., 0])[..., None] +
+                 ((b[..., 1] - b[..., 0])[..., None] +
+                  (c[..., 1] - c[..., 0])[..., None]*x)*x)
+            e = N.exp(-N.abs(d))
+            resp = N.where(d >= 0, 1, e)/(1 + e)*w
+            softPlus = N.maximum(d, 0) + N.log1p(e)
+            logL = (a[..., 0]*count + b[..., 0]*sumX + c[..., 0]*sumX2 +
+                    N.einsum('...n,...n->...', w, softPlus))
+            # M step, kept only for the rows still iterating
+            n1 = resp.sum(-1)
+            s1 = N.einsum('...n,...n->...', resp, x)
+            s2 = N.einsum('...n,...n,...n->...', resp, x, x)
+            nk = N.stack([count - n1, n1], axis=-1) + 1e-300
+            update = active[..., None]
+            weight = N.where(update, nk/count[..., None], weight)
+            newMu = N.stack([sumX - s1, s1], axis=-1)/nk
+            newVar = N.stack([sumX2 - s2, s2], axis=-1)/nk - newMu**2
+            mu = N.where(update, newMu, mu)
+            var = N.where(update, N.maximum(newVar, 1e-12), var)
+            # the log likelihood of the data in its own units
+            logL = logL - count*N.log(width)
+            active &= ~(N.abs(logL - lastLogL) <= tol*N.abs(logL))
+            lastLogL = logL
+
+    main = N.argmax(N.nan_to_num(weight, nan=0), axis=-1)[..., None]
+    mainMu = N.take_along_axis(mu, main, axis=-1)[..., 0]
+    mainVar = N.take_along_axis(var, main, axis=-1)[..., 0]
+    return (N.where(fitted, mean + mainMu*width, mean)[()],
+            N.where(fitted, N.sqrt(mainVar)*width, width)[()])
+
+
+def fitHistogram(cleanL, numBins, loBound=0, hiBound=0):
+    """This program returns the histogram counts and bin centers of the values
+    fitted by gaussianFit, over loBound to hiBound (by default +/- 3
+    standard deviations)."""
 
     if hiBound == 0:
         hiB = 3*N.std(cleanL)
@@ -29,27 +177,314 @@ def gaussianFit(data, numBins, figFileName, loBound=0, hiBound=0):
     else:
         loB = loBound
 
-    n, bins, patches = plt.hist(cleanL, bins=numBins, range=(loB, hiB))
-    amp = max(n.tolist())
-    mean = N.mean(cleanL)
-    width = N.std(cleanL)
-    p0 = [amp, mean, width]
+    n, bins = N.histogram(cleanL, bins=numBins, range=(loB, hiB))
     # get midpoint of bins to standardize length
-    startL = bins.tolist()
-    outL = []
-    for b in range(0, len(startL)-1):
-        outL.append(0.5*(startL[b]+startL[b+1]))
-    xA = N.array(outL)
-
-    # do least squares optimization
-    plsq = optimize.leastsq(residualsG, p0, args=(n, xA))
-    fitAmp, fitMean, fitStd = plsq[0][0], plsq[0][1], plsq[0][2]
-
-    # plot to check
-    check = gaussian(plsq[0], xA)
-    plt.plot(xA, n, 'bo', hold="True", alpha=0.5)
+    return n.astype(float), 0.5*(bins[:-1] + bins[1:])
+
+
+def gaussianFit(data, numBins, figFileName=None, loBound=0, hiBound=0):
+    """This program fits a Gaussian to the histogram of the non-NaN values
+    and returns its amplitude, mean and width.  The histogram spans
+    loBound to hiBound (by default +/- 3 standard deviations).  A figure of
+    the fit is saved only if figFileName is given."""
+
+    data = N.asarray(data, float)
+    cleanL = data[~N.isnan(data)]
+
+    n, xA = fitHistogram(cleanL, numBins, loBound, hiBound)
+
+    # do least squares optimization, starting from robust moments
+    mean, width = robustMoments(cleanL)
+    p0 = [n.max(), mean, width]
+    plsq = optimize.leastsq(residualsG, p0, args=(n, xA), Dfun=jacobianG)
+    # the width only enters squared, so the optimizer may return it negative
+    fitAmp, fitMean, fitStd = plsq[0][0], plsq[0][1], abs(plsq[0][2])
+
+    if figFileName is not None:
+        plotGaussianFit(xA, n, plsq[0], figFileName)
+
+    return fitAmp, fitMean, fitStd
+
+
+def centerAndWidth(data, method):
+    """This program returns the center and width of the values (of each row of
+    an (..., n) array) found, without an optimizer, by method:
+
+        median      median (width from the median absolute deviation)
+        trimmed     mean of the values within the 10th-90th percentiles
+        kde         mode of a kernel density estimate on a fixed grid
+        gmm         main component of a two Gaussian mixture"""
+
+    if method == 'median':
+        return robustMoments(data)
+    elif method == 'trimmed':
+        return trimmedMean(data)
+    elif method == 'kde':
+        return kdeMode(data)
+    elif method == 'gmm':
+        return gaussianMixtureFit(data)
+    raise ValueError("Unknown normalization method: " + str(method))
+
+
+def normalizationFit(data, numBins, method='gaussian', figFileName=None):
+    """This program returns the amplitude, mean and width of the Gaussian that
+    describes the non-NaN values, as gaussianFit does.  For the gaussian
+    method this is gaussianFit itself.  For the other methods the mean and
+    width come from centerAndWidth, and the amplitude is that of a Gaussian
+    holding all the values on gaussianFit's histogram, so no optimizer is
+    involved.  A figure of the fit is saved only if figFileName is given."""
+
+    data = N.asarray(data, float)
+    cleanL = data[~N.isnan(data)]
+    if method == 'gaussian':
+        return gaussianFit(cleanL, numBins, figFileName=figFileName)
+
+    fitMean, fitStd = centerAndWidth(cleanL, method)
+    n, xA = fitHistogram(cleanL, numBins)
+    fitAmp = 0.0
+    if fitStd > 0 and len(xA) > 1:
+        fitAmp = len(cleanL)*(xA[1] - xA[0])/(N.sqrt(2*N.pi)*fitStd)
+
+    if figFileName is not None:
+        plotGaussianFit(xA, n, [fitAmp, fitMean, fitStd], figFileName)
+
+    return fitAmp, fitMean, fitStd
+
+
+def histogramStack(data, numBins, loBounds, hiBounds, mask=None):
+    """This program histograms many sets of values at once.  data is an
+    (..., n) array (or a single (n,) array shared by every set), mask (if
+    given) selects the values of each set, and loBounds and hiBounds give
+    the range of each set.  NaN values are left out.  It returns the counts
+    and bin centers as (..., numBins) arrays, binned as numpy.histogram
+    does."""
+
+    data = N.asarray(data, float)
+    loBounds = N.asarray(loBounds, float)[..., None]
+    hiBounds = N.asarray(hiBounds, float)[..., None]
+    if mask is None:
+        mask = ~N.isnan(data)
+    shape = N.broadcast_shapes(data.shape, mask.shape, loBounds.shape,
+                               hiBounds.shape)
+
+    with N.errstate(invalid='ignore', divide='ignore'):
+        binPos = (data - loBounds) / (hiBounds - loBounds) * numBins
+    binPos = N.broadcast_to(binPos, shape)
+    # the top edge belongs to the last bin
+    binIndex = N.where(binPos == numBins, numBins - 1,
+                       N.floor(N.nan_to_num(binPos, nan=-1, posinf=numBins,
+                                            neginf=-1)))
+    inRange = (N.broadcast_to(mask, shape) & (binIndex >= 0) &
+               (binIndex < numBins))
+
+    numSets = int(N.prod(shape[:-1]))
+    offsets = N.arange(numSets).reshape(shape[:-1] + (1,)) * numBins
+    counts = N.bincount((binIndex.astype(N.int64) + offsets)[inRange],
+                        minlength=numSets*numBins).astype(float)
+    counts = counts.reshape(shape[:-1] + (numBins,))
+
+    edges = N.linspace(0, 1, numBins + 1)
+    centers = (loBounds + (hiBounds - loBounds)*0.5*(edges[:-1] +
+                                                     edges[1:]))
+    return counts, N.broadcast_to(centers, counts.shape)
+
+
+def logParabolaInit(counts, centers):
+    """This program estimates Gaussian parameters for each row of a stack of
+    histograms in closed form, by a weighted least squares fit of a
+    parabola to the log of the counts.  Rows where the parabola opens upward,
+    or fits the counts worse than a Gaussian with the histogram's moments,
+    use the moments instead.  It returns an
+    (numRows, 3) array of amplitude, mean and width."""
+
+    counts = N.asarray(counts, float)
+    x = N.broadcast_to(centers, counts.shape)
+    # center and scale x for a well-conditioned fit
+    total = counts.sum(-1)
+    with N.errstate(invalid='ignore', divide='ignore'):
+        mom1 = (counts*x).sum(-1) / total
+        mom2 = N.sqrt(N.maximum((counts*x**2).sum(-1) / total - mom1**2, 0))
+    scale = N.where(mom2 > 0, mom2, 1)[:, None]
+    u = (x - mom1[:, None]) / scale
+
+    w = counts
+    logN = N.log(N.where(counts > 0, counts, 1))
+    powers = N.stack([N.ones_like(u), u, u**2], axis=-1)
+    A = N.einsum('rb,rbi,rbj->rij', w, powers, powers)
+    B = N.einsum('rb,rbi,rb->ri', w, powers, logN)
+    A = A + 1e-12*N.eye(3)
+    coef = N.linalg.solve(A, B[..., None])[..., 0]
+
+    c = coef[:, 2]
+    good = (c < 0) & N.isfinite(c)
+    with N.errstate(invalid='ignore', divide='ignore'):
+        varU = N.where(good, -0.5/c, 1.0)
+        muU = coef[:, 1]*varU
+        amp = N.exp(coef[:, 0] + 0.5*muU**2/varU)
+    params = N.column_stack([amp, mom1 + muU*scale[:, 0],
+                             N.sqrt(varU)*scale[:, 0]])
+    fallback = N.column_stack([counts.max(-1), mom1, mom2])
+
+    # skewed histograms can give a parabola far off the peak, so keep
+    # whichever start fits the counts better
+    def cost(p):
+        with N.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            fit = p[:, 0:1]*N.exp(-0.5*((x - p[:, 1:2])/p[:, 2:3])**2)
+            return N.nan_to_num(((counts - fit)**2).sum(-1), nan=N.inf)
+
+    good &= cost(params) < cost(fallback)
+    params[~good] = fallback[~good]
+    return params
+
+
+def gaussianFitStack(counts, centers, p0=None, maxIter=100, tol=1e-10):
+    """This program fits a Gaussian to each row of a (numRows, numBins) stack
+    of histograms at once, with a Levenberg-Marquardt iteration run on all
+    rows together.  centers holds the bin centers, shared (numBins,) or per
+    row.  The fits start from p0 (numRows, 3) if given, otherwise from
+    logParabolaInit.  It returns arrays of the amplitude, mean and width of
+    each row (NaN for empty rows)."""
+
+    counts = N.asarray(counts, float)
+    x = N.broadcast_to(N.asarray(centers, float), counts.shape)
+    numRows = counts.shape[0]
+    if p0 is None:
+        p = logParabolaInit(counts, x)
+    else:
+        p = N.array(p0, float)
+
+    def residualsAndJacobian(p):
+        z = (x - p[:, 1:2]) / p[:, 2:3]
+        e = N.exp(-0.5*z**2)
+        r = counts - p[:, 0:1]*e
+        J = -N.stack([e, p[:, 0:1]*e*z/p[:, 2:3],
+                      p[:, 0:1]*e*z**2/p[:, 2:3]], axis=-1)
+        return r, J
+
+    active = N.all(N.isfinite(p), axis=1) & (p[:, 2] != 0)
+    lam = N.full(numRows, 1e-3)
+    r, J = residualsAndJacobian(N.where(active[:, None], p, 1))
+    cost = (r**2).sum(-1)
+    for n in range(0, maxIter):
+        if not N.any(active):
+            break
+        JtJ = N.einsum('rbi,rbj->rij', J, J)
+        Jtr = N.einsum('rbi,rb->ri', J, r)
+        diag = N.einsum('rii->ri', JtJ)
+        damped = JtJ + (lam[:, None]*N.maximum(diag, 1e-30))[:, :, None] * \
+            N.eye(3)
+        # the pseudo-inverse keeps degenerate rows (e.g. zero amplitude)
+        # from failing the whole stack
+        step = -N.matmul(N.linalg.pinv(damped), Jtr[..., None])[..., 0]
+        step[~active] = 0
+        trial = p + step
+        trialOk = N.all(N.isfinite(trial), axis=1) & (trial[:, 2] != 0)
+        rTrial, JTrial = residualsAndJacobian(N.where(trialOk[:, None],
+                                                      trial, p))
+        costTrial = N.where(trialOk, (rTrial**2).sum(-1), N.inf)
+
+        better = active & (costTrial < cost)
+        p[better] = trial[better]
+        r[better], J[better] = rTrial[better], JTrial[better]
+        converged = better & ((cost - costTrial) <= tol*N.maximum(cost, 1e-30))
+        cost[better] = costTrial[better]
+        lam = N.where(better, lam/10, lam*10)
+
+        # rows stop once they converge or can no longer improve
+        active &= ~converged & (lam < 1e16)
+
+    p[:, 2] = N.abs(p[:, 2])
+    p[counts.sum(-1) == 0] = N.nan
+    return p[:, 0], p[:, 1], p[:, 2]
+
+
+def bootstrapChunk(data, numBins, numResamples, seedSequence, loBound=0,
+                   hiBound=0, method='gaussian'):
+    """This program repeats the fit of normalizationFit (with the method
+    given) on numResamples resamples (with replacement) of data, drawn as
+    one index matrix from the random stream of seedSequence, and returns
+    their fit means and widths.  The fits of all the resamples are made at
+    once."""
+
+    rng = N.random.default_rng(seedSequence)
+    samples = data[rng.integers(0, len(data), size=(numResamples,
+                                                    len(data)))]
+
+    if method != 'gaussian':
+        return centerAndWidth(samples, method)
+
+    # histogram ranges as gaussianFit chooses them for each resample
+    if hiBound == 0:
+        hiB = 3*N.std(samples, axis=1)
+    else:
+        hiB = N.full(numResamples, float(hiBound))
+    if loBound == 0:
+        loB = -hiB
+    else:
+        loB = N.full(numResamples, float(loBound))
+
+    counts, centers = histogramStack(samples, numBins, loB, hiB)
+    # start each resample from the robust moments, as gaussianFit does
+    median = N.median(samples, axis=1)
+    width = 1.4826*N.median(N.abs(samples - median[:, None]), axis=1)
+    width = N.where(width == 0, N.std(samples, axis=1), width)
+    p0 = N.column_stack([counts.max(-1), median, width])
+    fitAmp, fitMean, fitStd = gaussianFitStack(counts, centers, p0=p0)
+    return fitMean, fitStd
+
+
+def bootstrapFit(data, numBins, numResamples=1000, seed=0, numWorkers=1,
+                 loBound=0, hiBound=0, level=0.95, chunkSize=100,
+                 method='gaussian'):
+    """This program estimates confidence intervals for the mean and width
+    found by normalizationFit with the method given, by resampling the
+    non-NaN values.  The resamples are split into chunks of chunkSize, each
+    with its own random stream spawned from seed, so the result depends
+    only on seed and not on how many worker processes share the chunks.  It
+    returns the (lower, upper) bounds of the fit mean and of the fit width
+    at the given confidence level."""
+
+    data = N.asarray(data, float)
+    cleanL = data[~N.isnan(data)]
+
+    chunkSizes = [min(chunkSize, numResamples - start)
+                  for start in range(0, numResamples, chunkSize)]
+    seedSequences = N.random.SeedSequence(seed).spawn(len(chunkSizes))
+    jobArgs = [(cleanL, numBins, chunkSizes[n], seedSequences[n], loBound,
+                hiBound, method) for n in range(0, len(chunkSizes))]
+
+    if numWorkers > 1 and len(jobArgs) > 1:
+        with ProcessPoolExecutor(max_workers=min(numWorkers,
+                                                 len(jobArgs))) as executor:
+            results = list(executor.map(bootstrapChunk, *zip(*jobArgs)))
+    else:
+        results = [bootstrapChunk(*a) for a in jobArgs]
+
+    fitMeans = N.concatenate([result[0] for result in results])
+    fitStds = N.concatenate([result[1] for result in results])
+    percentiles = [50*(1 - level), 50*(1 + level)]
+    return (tuple(N.nanpercentile(fitMeans, percentiles)),
+            tuple(N.nanpercentile(fitStds, percentiles)))
+
+
+def plotNormalizationFit(data, numBins, params, figFileName):
+    """This program saves a figure of the histogram of the non-NaN values, as
+    normalizationFit makes it, with the Gaussian of params (amplitude, mean
+    and width) found by normalizationFit."""
+
+    data = N.asarray(data, float)
+    n, xA = fitHistogram(data[~N.isnan(data)], numBins)
+    plotGaussianFit(xA, n, params, figFileName)
+
+
+def plotGaussianFit(xA, n, params, figFileName):
+    """This program saves a figure of a histogram and its Gaussian fit."""
+
+    # matplotlib is only loaded when a figure is made
+    from matplotlib import pylab as plt
+
+    check = gaussian(params, xA)
+    plt.plot(xA, n, 'bo', alpha=0.5)
     plt.plot(xA, check, 'r-')
     plt.savefig(figFileName)
     plt.clf()
-
-    return fitAmp, fitMean, fitStd
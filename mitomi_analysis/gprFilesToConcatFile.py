@@ -15,7 +15,10 @@ intensities under the button, (2) a gpr file gridded for DNA intensities under
 the button, (3) a gpr file gridded for DNA intensities within the chambers, and
 (4) an output file name (usually ProteinName_Concat.txt).  Optional inputs
 include flags to specify precisely how the gridding was done and the
-orientation of the tiff file.
+orientation of the tiff file.  Spots in the DNA and chamber files are matched
+to the protein file by block, column and row; protein spots missing from either
+file are reported and flagged as absent.  Files ending in .gz, .xz or .zst
+(zstd needs the zstandard package) are read and written compressed.
 
     -h    print this help message
     -p    protein button filename (required)
@@ -27,6 +30,10 @@ orientation of the tiff file.
           .tiff file
     -R    renumber concat file so that rows are numbered from bottom of
           .tiff file
+    -b    also save a binary column store (<output>.npc) that later steps
+          read in place of the text file
+    -j    number of files to read concurrently (optional, default 3; 1 reads
+          the files one after another)
 
 Example usage:
 mitomi concat -p Pho4_Protein.gpr -d Pho4_DNA.gpr -c Pho4_Chambers.gpr -o Pho4_Concat.txt -m
@@ -44,9 +51,11 @@ def main(argv=None):
     dFN = ""
     cFN = ""
     oFN = ""
+    numWorkers = 3
+    storeF = 0
 
     try:
-        optlist, args = getopt(argv[1:], "hp:c:d:o:amRr")
+        optlist, args = getopt(argv[1:], "hp:c:d:o:amRrj:b")
     except:
         print("")
         print(HELP_STRING)
@@ -78,13 +87,18 @@ def main(argv=None):
             rlF = 1
         elif opt == '-R':
             tbF = 1
+        elif opt == '-j':
+            numWorkers = int(opt_arg)
+        elif opt == '-b':
+            storeF = 1
 
     if pFN == "" or dFN == "" or cFN == "" or oFN == "":
         print(HELP_STRING)
         sys.exit(1)
 
     chipSingleconcUtils.concatGprFiles(pFN, cFN, dFN, oFN, singleF=sF, rlF=rlF,
-                                       tbF=tbF)
+                                       tbF=tbF, numWorkers=numWorkers,
+                                       storeF=storeF)
 
     return 0
 
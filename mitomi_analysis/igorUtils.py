@@ -0,0 +1,84 @@
+import struct
+import time
+import numpy as N
+from . import fileIOUtils
+
+# Igor binary wave (version 5) layout, from Igor Technical Note PTN003
+IBW_VERSION = 5
+BIN_HEADER_SIZE = 64
+WAVE_HEADER_SIZE = 320
+MAX_WAVE_NAME = 31
+MAX_DIMS = 4
+NT_FP64 = 4
+
+# seconds from the Igor (Macintosh) epoch, 1904-01-01, to the Unix epoch
+IGOR_EPOCH_OFFSET = 2082844800
+
+# packed experiment record holding a binary wave
+PACKED_WAVE_RECORD = 3
+PACKED_RECORD_HEADER_SIZE = 8
+
+
+def igorWaveBytes(array, waveName):
+    """This program returns the contents of an Igor binary wave (version 5)
+    file holding array as double precision values.  Rows of the array are
+    Igor's first dimension, so the data are written in column-major order
+    with a single buffer copy."""
+
+    data = N.asarray(array, '<f8')
+    if data.ndim == 0 or data.ndim > MAX_DIMS:
+        raise ValueError("Igor waves have 1 to 4 dimensions")
+    dataBytes = data.tobytes(order='F')
+    nDim = list(data.shape) + [0]*(MAX_DIMS - data.ndim)
+    name = waveName.encode('ascii')[:MAX_WAVE_NAME]
+    now = int(time.time()) + IGOR_EPOCH_OFFSET
+
+    waveHeader = bytearray(WAVE_HEADER_SIZE)
+    struct.pack_into('<IIih', waveHeader, 4, now, now, data.size, NT_FP64)
+    struct.pack_into('<h', waveHeader, 26, 1)  # whVersion
+    waveHeader[28:28 + len(name)] = name
+    struct.pack_into('<4i', waveHeader, 68, *nDim)
+    struct.pack_into('<4d', waveHeader, 84, *([1.0]*MAX_DIMS))  # sfA
+    struct.pack_into('<4d', waveHeader, 116, *([0.0]*MAX_DIMS))  # sfB
+
+    binHeader = bytearray(BIN_HEADER_SIZE)
+    struct.pack_into('<hhi', binHeader, 0, IBW_VERSION, 0,
+                     WAVE_HEADER_SIZE + len(dataBytes))
+
+    # the checksum makes the 16-bit sum of both headers zero
+    headerShorts = N.frombuffer(bytes(binHeader + waveHeader), '<i2')
+    checksum = -int(headerShorts.astype(N.int64).sum())
+    struct.pack_into('<h', binHeader, 2,
+                     ((checksum + 0x8000) & 0xFFFF) - 0x8000)
+
+    return bytes(binHeader) + bytes(waveHeader) + dataBytes
+
+
+def writeIgorWave(fileName, array, waveName):
+    """This program saves an array as an Igor binary wave (.ibw) file."""
+
+    fileIOUtils.writeFile(fileName, igorWaveBytes(array, waveName))
+
+
+def writePackedExperiment(fileName, waveNames, arrays):
+    """This program saves arrays as binary waves in a single Igor packed
+    experiment (.pxp) file, one wave record per array."""
+
+    outFile = fileIOUtils.openAtomic(fileName, 'wb')
+    for n in range(0, len(arrays)):
+        waveBytes = igorWaveBytes(arrays[n], waveNames[n])
+        outFile.write(struct.pack('<Hhi', PACKED_WAVE_RECORD, 0,
+                                  len(waveBytes)))
+        outFile.write(waveBytes)
+    outFile.close()
+
+
+def writeTextMatrix(fileName, array):
+    """This program writes a 2D array as a tab-delimited text matrix for
+    loading into Igor, in one bulk write.  Each line ends with a tab, as the
+    matrices have always been written."""
+
+    array = N.asarray(array)
+    outFile = fileIOUtils.openAtomic(fileName, 'w')
+    N.savetxt(outFile, array, fmt='%s', delimiter='\t', newline='\t\n')
+    outFile.close()
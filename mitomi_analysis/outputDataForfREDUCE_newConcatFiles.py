@@ -2,6 +2,7 @@ import sys
 import os
 from getopt import getopt
 from . import fileIOUtils
+from . import chipSingleconcUtils
 import numpy as N
 
 
@@ -15,7 +16,8 @@ This program takes a concat_processed filename and outputs
 input files for fREDUCE.
 
      -h    print this help message
-     -c    concat_processed filename
+     -c    concat_processed filename (a column store saved alongside it by
+           process -b is read instead)
 
 Example usage:
 mitomi prereduce -c Pho4_Concat_Processed.txt
@@ -57,27 +59,26 @@ def main(argv=None):
     curDir = "./"
     tName = os.path.split(cFN)[1].split('_')[0]
 
-    seq, rNN, DNAN = [], [], []
-    f = open(cFN, 'r')
-    lineIndex = 0
-    for line in f:
-        lineIndex = lineIndex + 1
-        if lineIndex != 1:
-            tempList = line.strip().split('\t')
-            if tempList[17] != '' and not N.isnan(float(tempList[20])):
-                seq.append(tempList[17])
-                rNN.append(tempList[20])
-                DNAN.append(tempList[18])
-            else:
-                pass
-    f.close()
-
-    sFileName = curDir + tName + '_Seq.fas'
-    sFile = open(sFileName, 'w')
-    rFileName = curDir + tName + '_rNN.txt'
-    rFile = open(rFileName, 'w')
-    dFN = curDir + tName + '_DNAN.txt'
-    dFile = open(dFN, 'w')
+    # read the sequences, DNAN and rNN values (from the column store saved
+    # alongside the file, if there is one) and keep the spots with a
+    # sequence and an rNN value
+    columnD = chipSingleconcUtils.loadProcessedColumns(
+        cFN, ['OligoSeq', 'DNAN', 'rNN'])
+    keep = ((columnD['OligoSeq'] != '') &
+            ~N.isnan(columnD['rNN'].astype(float)))
+    seq = columnD['OligoSeq'][keep].tolist()
+    rNN = [str(a) for a in columnD['rNN'][keep].tolist()]
+    DNAN = [str(a) for a in columnD['DNAN'][keep].tolist()]
+
+    # write straight into fREDUCE/, each file appearing only once complete
+    oDir = curDir + 'fREDUCE/'
+    fileIOUtils.createNewDir(oDir)
+    sFileName = oDir + tName + '_Seq.fas'
+    sFile = fileIOUtils.openAtomic(sFileName, 'w')
+    rFileName = oDir + tName + '_rNN.txt'
+    rFile = fileIOUtils.openAtomic(rFileName, 'w')
+    dFN = oDir + tName + '_DNAN.txt'
+    dFile = fileIOUtils.openAtomic(dFN, 'w')
     for b in range(0, len(seq)):
         sFile.write('>Seq_' + str(b) + '\n' + seq[b] + '\n')
         rFile.write('Seq_' + str(b) + '\t' + rNN[b] + '\n')
@@ -86,11 +87,6 @@ def main(argv=None):
     rFile.close()
     dFile.close()
 
-    fileIOUtils.createNewDir(curDir + '/fREDUCE/')
-    os.system('mv ' + sFileName + ' ' + curDir + '/fREDUCE/')
-    os.system('mv ' + rFileName + ' ' + curDir + '/fREDUCE/')
-    os.system('mv ' + dFN + ' ' + curDir + '/fREDUCE/')
-
     return 0
 
 
@@ -1,12 +1,16 @@
 import sys
 import os
+import glob
+import traceback
 from getopt import getopt
+from concurrent.futures import ProcessPoolExecutor
 from . import chipSingleconcUtils
 from . import plotUtils
 import numpy as N
 from . import fileIOUtils
-from . import fitUtils
-from scipy import stats
+from . import chipStages
+from . import chipAnalysis
+from . import spotLayout
 
 
 HELP_STRING = """
@@ -17,7 +21,8 @@ Updated by: Tyler Shimko, February 2016
 
 This program is designed to take a single concatenated genepix
 file and a spot2Oligo file and output:
-1.  individual text files containing values sorted by oligo and by replicate
+1.  a store (and optionally individual text files) containing values sorted
+    by oligo and by replicate
 2.  graphs showing values for each oligo and histograms
 3.  a processed concat file with oligo numbers and sequences assigned to each
     spot
@@ -26,7 +31,11 @@ Optional threshhold values can be given to set a lower bound on permissible
 background subtracted intensities.
 
      -h     print this help message
-     -c     concat filename (required)
+     -c     concat filename (required); may be given several times, as a
+            quoted glob pattern (e.g. -c "*/*_Concat.txt"), or followed by
+            more concat filenames to process a batch of chips.  A concat
+            file ending in .gz, .xz or .zst is read compressed, and its
+            processed file is compressed the same way
      -s     spot2oligo filename (optional, default is
             /Users/pollyfordyce/Documents/lib/perl/PR8MerSpot2OligoFile.txt)
      -p     pBSub threshold value (optional)
@@ -36,9 +45,46 @@ background subtracted intensities.
      -f     filename containing oligo numbers and sequences
             (default = /Users/pollyfordyce/Documents/lib/perl/8MerLib.txt)
      -y     do not truncate sequences to eliminate common ends (optional)
+     -q     also run chip-analysis (with its default settings) on the same
+            data, sharing the parsing and flag handling (optional)
+     -z     do not use the stage cache (.mitomi_cache next to the concat
+            file), which lets re-runs with new thresholds skip the stages
+            the thresholds do not affect (optional; the cache is never
+            pruned, delete the directory to clear it)
+     -w     number of worker processes: chips processed at once in batch
+            mode, or processes sharing the bootstrap of a single chip
+            (optional, default is the number of CPUs)
+     -g     save figures of the normalization fits in NormalizationInfo/
+            (optional)
+     -m     how the DNABSub, pBSub and ratio values are centered: gaussian
+            (Gaussian fit, the default), median, trimmed (10% trimmed mean),
+            kde (kernel density mode) or gmm (main component of a two
+            Gaussian mixture) (optional)
+     -r     number of bootstrap resamples used for the confidence intervals
+            of the normalization fits (made with the -m method), written to
+            <concat root>_NormalizationCI.txt; 0 skips the bootstrap
+            (optional, default 1000)
+     -i     use two-sided p-values for the rNN z-scores (optional, default
+            is one-sided, upper tail)
+     -e     number of significant digits of the values in the processed
+            file (optional, default is every digit)
+     -b     also save the processed file as a binary column store
+            (<concat root>_Processed.npc), which scatter-plot and prereduce
+            read in place of the text file (optional)
+     -l     also write the replicates of each oligo to the legacy text files
+            OligoAnalysis/TextFiles/Oligo_<n>.dat; by default they are only
+            saved to the single store OligoAnalysis/OligoData.npy, from
+            which export-oligos writes them later (optional)
+
+When more than one concat file is given, the outputs of each chip are
+written to a directory named after its concat file (e.g. chip1_Concat/ for
+chip1_Concat.txt) and a summary of all chips is written to
+ProcessSummary.txt in the current directory.  The traceback of a chip that
+fails is saved to ProcessError.txt in its directory.
 
 Example:
 python processConcat_PR8_v1.py -c concatFile_042108.txt
+mitomi process -w 8 -c "screen/*_Concat.txt"
 """
 
 
@@ -46,7 +92,7 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv
 
-    concatFileName = ""
+    concatFileNames = []
 
     data_dir = os.path.join(os.path.dirname(__file__), "data")
 
@@ -59,9 +105,19 @@ def main(argv=None):
     nanFlag = 0
     oligoSeqFileName = os.path.join(data_dir, "8MerLib.txt")
     truncFlag = 1
+    qcFlag = 0
+    cacheFlag = 1
+    numWorkers = os.cpu_count() or 1
+    fitFigFlag = 0
+    normMethod = 'gaussian'
+    numResamples = 1000
+    sides = 1
+    precision = None
+    storeF = 0
+    oligoTextFlag = 0
 
     try:
-        optlist, args = getopt(argv[1:], "hc:s:p:d:t:nf:y")
+        optlist, args = getopt(argv[1:], "hc:s:p:d:t:nf:yqzw:gm:r:ie:bl")
     except:
         print("")
         print(HELP_STRING)
@@ -80,7 +136,7 @@ def main(argv=None):
             print(HELP_STRING)
             sys.exit(1)
         elif opt == '-c':
-            concatFileName = opt_arg
+            concatFileNames.extend(expandConcatFileNames(opt_arg))
         elif opt == '-s':
             spot2OligoFileName = opt_arg
         elif opt == '-p':
@@ -95,20 +151,219 @@ def main(argv=None):
             oligoSeqFileName = opt_arg
         elif opt == '-y':
             truncFlag = 1
-
-    if concatFileName == "":
+        elif opt == '-q':
+            qcFlag = 1
+        elif opt == '-z':
+            cacheFlag = 0
+        elif opt == '-w':
+            numWorkers = int(opt_arg)
+        elif opt == '-g':
+            fitFigFlag = 1
+        elif opt == '-m':
+            normMethod = opt_arg
+            if normMethod not in chipSingleconcUtils.NORMALIZATION_METHODS:
+                print("Unknown normalization method: " + normMethod)
+                print(HELP_STRING)
+                sys.exit(1)
+        elif opt == '-r':
+            numResamples = int(opt_arg)
+        elif opt == '-i':
+            sides = 2
+        elif opt == '-e':
+            precision = int(opt_arg)
+        elif opt == '-b':
+            storeF = 1
+        elif opt == '-l':
+            oligoTextFlag = 1
+
+    for arg in args:
+        concatFileNames.extend(expandConcatFileNames(arg))
+
+    if len(concatFileNames) == 0:
         print(HELP_STRING)
         sys.exit(1)
 
-    # get lists from concat file
-    blocks, oRows, oCols, rows, cols, flags, pFg, DNAFg, pBg, DNABg, chFg, \
-        pBSub, DNABSub, chBSub, ratio, ratioNorm, oligoNum = \
-        chipSingleconcUtils.outputInfoFromConcatFile(concatFileName,
-                                                     spot2OligoFileName,
-                                                     pTh=pTh,
-                                                     DNATh=DNATh,
-                                                     chTh=chTh,
-                                                     nanFlag=nanFlag)
+    settings = dict(pTh=pTh, DNATh=DNATh, chTh=chTh, nanFlag=nanFlag,
+                    truncFlag=truncFlag, qcFlag=qcFlag, cacheFlag=cacheFlag,
+                    fitFigFlag=fitFigFlag, normMethod=normMethod,
+                    numResamples=numResamples, bootWorkers=numWorkers,
+                    sides=sides, precision=precision, storeF=storeF,
+                    oligoTextFlag=oligoTextFlag)
+
+    if len(concatFileNames) == 1:
+        processChipFile(concatFileNames[0], spot2OligoFileName,
+                        oligoSeqFileName, settings)
+        return 0
+
+    summaryList = processChipBatch(concatFileNames, spot2OligoFileName,
+                                   oligoSeqFileName, settings,
+                                   numWorkers=numWorkers)
+    writeBatchSummary("ProcessSummary.txt", summaryList)
+    numFailed = len([a for a in summaryList if a['Status'] != 'ok'])
+    print("Processed " + str(len(summaryList) - numFailed) + " of " +
+          str(len(summaryList)) + " chips, summary written to "
+          "ProcessSummary.txt")
+
+    return 0 if numFailed == 0 else 1
+
+
+def expandConcatFileNames(pattern):
+    """This program expands a glob pattern into the matching concat files (a
+    name without wildcards is returned as it is)."""
+
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    return [pattern]
+
+
+def processChipFile(concatFileName, spot2OligoFileName, oligoSeqFileName,
+                    settings, outDir=None):
+    """This program runs process (and, if qcFlag is set, chip-analysis) on one
+    concat file and returns the summary of processChip."""
+
+    stages = chipStages.getChipStages(concatFileName, spot2OligoFileName,
+                                      cacheFlag=settings['cacheFlag'])
+    if settings['qcFlag'] != 0:
+        chipAnalysis.analyzeChip(stages, outDir=outDir)
+
+    return processChip(stages, oligoSeqFileName, pTh=settings['pTh'],
+                       DNATh=settings['DNATh'], chTh=settings['chTh'],
+                       nanFlag=settings['nanFlag'],
+                       truncFlag=settings['truncFlag'], outDir=outDir,
+                       fitFigFlag=settings['fitFigFlag'],
+                       normMethod=settings['normMethod'],
+                       numResamples=settings['numResamples'],
+                       bootWorkers=settings['bootWorkers'],
+                       sides=settings['sides'],
+                       precision=settings['precision'],
+                       storeF=settings['storeF'],
+                       oligoTextFlag=settings['oligoTextFlag'])
+
+
+# file in the output directory of a chip holding the traceback of a failure
+BATCH_ERROR_FILE = 'ProcessError.txt'
+
+
+def batchOutputDir(concatFileName):
+    """This program returns the output directory of a chip in batch mode,
+    named after its concat file."""
+
+    return fileIOUtils.fileRoot(concatFileName)
+
+
+def initBatchWorker(layoutCache, seqDictCache):
+    """This program installs the layout and library parsed by the parent in a
+    batch worker process."""
+
+    spotLayout._layoutCache.update(layoutCache)
+    chipSingleconcUtils._seqDictCache.update(seqDictCache)
+
+
+def runBatchChip(concatFileName, spot2OligoFileName, oligoSeqFileName,
+                 settings):
+    """This program processes one chip of a batch, returning its summary (with
+    the error instead if it fails, so that one bad chip does not stop the
+    batch).  The traceback of a failure is printed and saved to
+    ProcessError.txt in the output directory of the chip."""
+
+    outDir = batchOutputDir(concatFileName)
+    try:
+        fileIOUtils.createNewDir(outDir)
+        summaryD = processChipFile(concatFileName, spot2OligoFileName,
+                                   oligoSeqFileName, settings, outDir=outDir)
+        summaryD['Status'] = 'ok'
+    except Exception as error:
+        errorText = traceback.format_exc()
+        print("Processing " + concatFileName + " failed:\n" + errorText)
+        summaryD = {'Status': 'error: ' + repr(error)}
+        try:
+            errorFileName = os.path.join(outDir, BATCH_ERROR_FILE)
+            fileIOUtils.writeFile(errorFileName, errorText)
+            summaryD['Status'] += ' (see ' + errorFileName + ')'
+        except OSError:
+            pass
+    summaryD['ConcatFile'] = concatFileName
+    summaryD['OutputDir'] = outDir
+    return summaryD
+
+
+def processChipBatch(concatFileNames, spot2OligoFileName, oligoSeqFileName,
+                     settings, numWorkers=1):
+    """This program processes many chips with a pool of worker processes and
+    returns the list of their summaries, in the order the chips were given.
+    The layout and library files are parsed once here and handed to the
+    workers."""
+
+    # the chips are already spread over the workers, so each bootstraps in
+    # its own process
+    settings = dict(settings, bootWorkers=1)
+
+    spotLayout.loadSpotLayout(spot2OligoFileName)
+    chipSingleconcUtils.createDictFromSeqFile(
+        oligoSeqFileName, truncFlag=settings['truncFlag'])
+
+    numWorkers = max(1, min(numWorkers, len(concatFileNames)))
+    jobArgs = [(concatFileName, spot2OligoFileName, oligoSeqFileName,
+                settings) for concatFileName in concatFileNames]
+    if numWorkers == 1:
+        return [runBatchChip(*a) for a in jobArgs]
+
+    with ProcessPoolExecutor(
+            max_workers=numWorkers, initializer=initBatchWorker,
+            initargs=(spotLayout._layoutCache,
+                      chipSingleconcUtils._seqDictCache)) as executor:
+        futures = [executor.submit(runBatchChip, *a) for a in jobArgs]
+        return [future.result() for future in futures]
+
+
+# columns of the batch summary file
+SUMMARY_COLUMNS = ['ConcatFile', 'OutputDir', 'Status', 'NumSpots',
+                   'NumFlagged', 'NumRatios', 'rNNFitMean', 'rNNFitStd']
+
+
+def writeBatchSummary(fileName, summaryList):
+    """This program writes one line per chip of a batch to a tab-delimited
+    summary file."""
+
+    lines = ['\t'.join(SUMMARY_COLUMNS)]
+    for summaryD in summaryList:
+        lines.append('\t'.join(str(summaryD.get(name, ''))
+                               for name in SUMMARY_COLUMNS))
+    fileIOUtils.writeFile(fileName, '\n'.join(lines) + '\n')
+
+
+def processChip(stages, oligoSeqFileName, pTh=-500, DNATh=-500, chTh=-1000,
+                nanFlag=0, truncFlag=1, outDir=None, fitFigFlag=0,
+                normMethod='gaussian', numResamples=1000, bootWorkers=1,
+                sides=1, precision=None, storeF=0, oligoTextFlag=0):
+    """This program writes the processed concat file, oligo text files and
+    graphs for the chip handled by a ChipStages object, and returns a summary
+    of the chip.  The output directories, and the files named after the
+    concat file (<concat root>_Processed.txt, ...), are made in outDir (by
+    default the directory of the concat file).  Figures of the normalization
+    fits are only saved (in NormalizationInfo/) if fitFigFlag is set.  The
+    values are centered with the normalizeValues method normMethod.  Unless
+    numResamples is 0, bootstrap confidence intervals of the normalization
+    fits are written to <concat root>_NormalizationCI.txt, with the
+    resamples spread over bootWorkers processes.  The p-values of the rNN
+    z-scores are one-sided (upper tail) or, if sides is 2, two-sided.  The
+    processed file is written with precision significant digits (by default
+    every digit), and also as a column store if storeF is set.  The
+    replicates of each oligo are saved to OligoAnalysis/OligoData.npy, and
+    also to OligoAnalysis/TextFiles/Oligo_<n>.dat if oligoTextFlag is
+    set."""
+
+    concatFileName = stages.concatFileName
+    spot2OligoFileName = stages.spot2OligoFileName
+
+    # the files named after the concat file go next to it, or in outDir
+    outRoot = fileIOUtils.fileRoot(concatFileName)
+    if outDir is not None:
+        outRoot = os.path.join(outDir, os.path.basename(outRoot))
+
+    # get chip data from concat file
+    chip = stages.processed(pTh, DNATh, chTh, nanFlag)
+    rows, cols, oligoNum = chip.row, chip.col, chip.oligoNum
 
     # make a dictionary linking oligo number and sequence
     oligoSeqD = chipSingleconcUtils.createDictFromSeqFile(
@@ -122,157 +377,144 @@ def main(argv=None):
         else:
             oligoSeq.append('EMPTY')
 
-    # histogram DNABSub and PBSub waves and fit them to a Gaussian
-    dataDir = (os.path.split(concatFileName)[0]
+    # histogram DNABSub and PBSub waves and fit them to a Gaussian (the fit
+    # figures are only drawn if asked for)
+    dataDir = (outDir if outDir is not None
+               else os.path.split(concatFileName)[0]
                if os.path.split(concatFileName)[0] != ""
                else ".")
-    analysisDir = str(dataDir) + "/NormalizationInfo/"
-    fileIOUtils.createNewDir(analysisDir)
+    analysisDir = None
+    if fitFigFlag != 0:
+        analysisDir = str(dataDir) + "/NormalizationInfo/"
+        fileIOUtils.createNewDir(analysisDir)
 
     # normalize waves so that they are centered around zero, normalize ratio
     # to a max of 1
-    DNAN = chipSingleconcUtils.normalizeValues(
-        DNABSub, analysisDir, "DNABSub.png", inHi=0, numBins=100)
-    pN = chipSingleconcUtils.normalizeValues(
-        pBSub, analysisDir, "pBSub.png", inHi=0, numBins=100)
-    rN = chipSingleconcUtils.normalizeValues(
-        ratio, analysisDir, "ratio.png", inHi=0, numBins=100)
-    rNN = chipSingleconcUtils.normalizeMaxValue(rN)
-
-    # check results of normalization to see if they're reasonable
-    checkDir = analysisDir + "CheckFits/"
-    fileIOUtils.createNewDir(checkDir)
-    dParams = fitUtils.gaussianFit(DNAN, numBins=100,
-                                   figFileName=checkDir + 'DNAN.png',
-                                   loBound=0,
-                                   hiBound=0)
-    pParams = fitUtils.gaussianFit(pN, numBins=100, loBound=0, hiBound=0,
-                                   figFileName=checkDir + 'pN.png')
-    rParams = fitUtils.gaussianFit(
-        rNN, numBins=100, loBound=0, hiBound=0,
-        figFileName=checkDir + 'rNN.png')
-
-    zScore, pVal = [], []
-    for a in rNN:
-        if not N.isnan(a):
-            zS = float(a - rParams[1]) / rParams[2]
-            zScore.append(zS)
-            pVal.append(stats.norm.sf(zS))
-        else:
-            zScore.append(N.nan)
-            pVal.append(N.nan)
-
-    # output all of these results to a new file to see what happened
-    outFileName = concatFileName[:-4] + '_Processed.txt'
-    outFile = open(outFileName, 'w')
-    outFile.write(
-        'Block\tOrigRow\tOrigCol\tRow\tCol\tFlag\tpFg\tDNAFg\tpBg\tDNABg\t\
-        chFg\tpBSub\tDNABSub\tchBSub\tRatio\tRatioNorm\tOligoNum\tOligoSeq\t\
-        DNAN\trN\trNN\tZScore\tpVal\n')
-    outLists = [blocks, oRows, oCols, rows, cols, flags, pFg, DNAFg, pBg,
-                DNABg, chFg, pBSub, DNABSub, chBSub, ratio, ratioNorm,
-                oligoNum, oligoSeq, DNAN, rN, rNN, zScore, pVal]
-    for m in range(0, len(outLists[0])):
-        for n in range(0, len(outLists)):
-            outFile.write(str(outLists[n][m]) + '\t')
-        outFile.write('\n')
-    outFile.close()
-
-    # determine the number of oligos and concentrations
-    numOligos = chipSingleconcUtils.calcNumOligos(spot2OligoFileName)
-    # determine the number of spots per oligo
-    numSpotsPerOligo = chipSingleconcUtils.calcNumSpotsPerOligo(
-        spot2OligoFileName)
-    print("Number of oligos = " + str(numOligos))
-    print("Number of spots per oligo = " + str(numSpotsPerOligo))
-
-    # create a new directory to hold oligo analysis output
-    analysisDir = str(dataDir) + "/OligoAnalysis/"
-    fileIOUtils.createNewDir(analysisDir)
-    thFileName = analysisDir + "Threshholds.txt"
-    chipSingleconcUtils.writeThresholdsToFile(thFileName, pTh, DNATh, chTh)
-
-    # create a directory to hold text files
-    textDir = analysisDir + "TextFiles/"
-    fileIOUtils.createNewDir(textDir)
-
-    # create 2D arrays for DNAN and rNN data
-    chBSubArray = chipSingleconcUtils.dataArray(
-        spot2OligoFileName, cols, rows, chBSub)
-    colArray = chipSingleconcUtils.dataArray(
-        spot2OligoFileName, cols, rows, cols)
-    rowArray = chipSingleconcUtils.dataArray(
-        spot2OligoFileName, cols, rows, rows)
-    DNANArray = chipSingleconcUtils.dataArray(
-        spot2OligoFileName, cols, rows, DNAN)
-    pBSubArray = chipSingleconcUtils.dataArray(
-        spot2OligoFileName, cols, rows, pBSub)
-    rNNArray = chipSingleconcUtils.dataArray(
-        spot2OligoFileName, cols, rows, rNN)
-
-    # slice arrays to create text files for each oligo
-    for n in range(0, numOligos):
-        # create text file
-        outFileName = textDir + "Oligo_" + str(n + 1) + ".dat"
-        outFile = open(outFileName, 'w')
-        outFile.write('#Rep\tpBSub\tDNAN\trNN\tchBSub\tRow\tCol\n')
-        DNANByOligo = DNANArray[n, :].tolist()
-        pBSubByOligo = pBSubArray[n, :].tolist()
-        rNNByOligo = rNNArray[n, :].tolist()
-        chBSubByOligo = chBSubArray[n, :].tolist()
-        rowByOligo = rowArray[n, :].tolist()
-        colByOligo = colArray[n, :].tolist()
-        repNum = (N.arange(numSpotsPerOligo + 1)).tolist()
-        # write out the text
-        for m in range(0, len(rNNByOligo)):
-            writeList = [str(repNum[m] + 1), '\t', str(pBSubByOligo[m]), '\t',
-                         str(DNANByOligo[m]), '\t', str(rNNByOligo[m]), '\t',
-                         str(chBSubByOligo[m]), '\t', str(rowByOligo[m]), '\t',
-                         str(colByOligo[m]), '\n']
-            for item in writeList:
-                outFile.write(item)
-        outFile.close()
-
-    # create a directory to hold graphs
-    graphDir = analysisDir + "Graphs/"
-    fileIOUtils.createNewDir(graphDir)
-
-    # create 2D arrays to hold oligo information
-    dimensions = (numOligos + 1, numSpotsPerOligo)
-    oligoNumArray = N.zeros(dimensions, float)
-    for n in range(0, numOligos):
-        oligoNumArray[n, :] = (n + 1)
-
-    # reshape arrays for plotting
-    numPoints = DNANArray.shape[0] * DNANArray.shape[1]
-    oligoNumPlotting = N.reshape(oligoNumArray, (numPoints,))
-    DNANPlotting = N.reshape(DNANArray, (numPoints,))
-    rNNPlotting = N.reshape(rNNArray, (numPoints,))
-
-    figFileRoot = graphDir + "DNANVsOligo"
-    plotUtils.createAndSaveFig(oligoNumPlotting, DNANPlotting, figFileRoot,
-                               xLabel="Oligo", yLabel="Intensity", yMin=0,
-                               xMin=0, xMax=numOligos)
-    figFileRoot = graphDir + "rNNVsOligo"
-    plotUtils.createAndSaveFig(oligoNumPlotting, rNNPlotting, figFileRoot,
-                               xLabel="Oligo", yLabel="Ratio", yMin=0, xMin=0,
-                               xMax=numOligos)
-
-    # now go through and make histograms of all DNABSub, Ratio, and RatioNorm
-    # values
-    figFileRoot = graphDir + '/DNANHist'
-    plotUtils.makeHist(DNAN, figFileRoot, numBins=1000, xLabel='DNAN',
-                       yLabel='Number of Events', log=False, removeNaNFlag=1)
-    figFileRoot = graphDir + '/DNANHistLog'
-    plotUtils.makeHist(DNAN, figFileRoot, numBins=1000, xLabel='DNAN',
-                       yLabel='Number of Events', log=True, removeNaNFlag=1)
-    figFileRoot = graphDir + '/rNNHist'
-    plotUtils.makeHist(rNN, figFileRoot, numBins=1000, xLabel='rNN',
-                       yLabel='Number of Events', log=False, removeNaNFlag=1)
-    figFileRoot = graphDir + '/rNNHistLog'
-    plotUtils.makeHist(rNN, figFileRoot, numBins=1000, xLabel='rNN',
-                       yLabel='Number of Events', log=True, removeNaNFlag=1)
-    return 0
+    normD = stages.normalize(pTh, DNATh, chTh, nanFlag, analysisDir,
+                             method=normMethod)
+    DNAN, rN, rNN = normD['DNAN'], normD['rN'], normD['rNN']
+
+    # check results of normalization to see if they're reasonable, and
+    # calculate z-scores, p-values, q-values and combined oligo p-values
+    zD = stages.zscore(pTh, DNATh, chTh, nanFlag, analysisDir,
+                       method=normMethod, sides=sides)
+    zScore, pVal = zD['zScore'], zD['pVal']
+    qVal, oligoPVal = zD['qVal'], zD['oligoPVal']
+
+    # estimate how stable the normalization fits are (before the writer
+    # thread below is started, as the bootstrap may fork worker processes)
+    if numResamples > 0:
+        bootD = stages.bootstrap(pTh, DNATh, chTh, nanFlag, numResamples,
+                                 numWorkers=bootWorkers, method=normMethod)
+
+    # write the output files on a background thread while the later
+    # outputs are computed
+    with fileIOUtils.OutputWriter() as writer:
+
+        if numResamples > 0:
+            writer.submit(chipSingleconcUtils.writeBootstrapCIs,
+                          outRoot + '_NormalizationCI.txt', bootD,
+                          numResamples, method=normMethod)
+
+        # output all of these results to a new file to see what happened
+        # (compressed like the concat file)
+        outFileName = (outRoot + '_Processed.txt' +
+                       fileIOUtils.compressionExt(concatFileName))
+        outLists = [chip.block, chip.origRow, chip.origCol, chip.row,
+                    chip.col, chip.flag, chip.pFg, chip.DNAFg, chip.pBg,
+                    chip.DNABg, chip.chFg, chip.pBSub, chip.DNABSub,
+                    chip.chBSub, chip.ratio, chip.ratioNorm, oligoNum,
+                    N.array(oligoSeq, str), DNAN, rN, rNN, zScore, pVal,
+                    qVal, oligoPVal]
+        writer.submit(chipSingleconcUtils.writeProcessedFile, outFileName,
+                      outLists, precision=precision, storeF=storeF)
+
+        # determine the number of oligos and concentrations
+        numOligos = chipSingleconcUtils.calcNumOligos(spot2OligoFileName)
+        # determine the number of spots per oligo
+        numSpotsPerOligo = chipSingleconcUtils.calcNumSpotsPerOligo(
+            spot2OligoFileName)
+        print("Number of oligos = " + str(numOligos))
+        print("Number of spots per oligo = " + str(numSpotsPerOligo))
+
+        # create a new directory to hold oligo analysis output
+        analysisDir = str(dataDir) + "/OligoAnalysis/"
+        fileIOUtils.createNewDir(analysisDir)
+        thFileName = analysisDir + "Threshholds.txt"
+        writer.submit(chipSingleconcUtils.writeThresholdsToFile, thFileName,
+                      pTh, DNATh, chTh)
+
+        # place the replicates of each oligo in (oligo, replicate) arrays
+        chBSubArray, colArray, rowArray, DNANArray, pBSubArray, rNNArray = \
+            chipSingleconcUtils.dataTensor(
+                spot2OligoFileName, cols, rows,
+                [chip.chBSub, cols, rows, DNAN, chip.pBSub, rNN])
+
+        # save them all to a single per-oligo store, and optionally write the
+        # text files for each oligo
+        oligoFields = [pBSubArray[:numOligos], DNANArray[:numOligos],
+                       rNNArray[:numOligos], chBSubArray[:numOligos],
+                       rowArray[:numOligos], colArray[:numOligos]]
+        # (the writes are done in order, so the store is complete when the
+        # text files are exported from it)
+        writer.submit(chipSingleconcUtils.writeOligoStore,
+                      analysisDir + "OligoData.npy", oligoFields)
+        if oligoTextFlag != 0:
+            textDir = analysisDir + "TextFiles/"
+            fileIOUtils.createNewDir(textDir)
+            writer.submit(chipSingleconcUtils.exportOligoDatFiles,
+                          analysisDir + "OligoData.npy", textDir)
+
+        # create a directory to hold graphs (drawn while the files are
+        # written)
+        graphDir = analysisDir + "Graphs/"
+        fileIOUtils.createNewDir(graphDir)
+
+        # create 2D arrays to hold oligo information
+        dimensions = (numOligos + 1, numSpotsPerOligo)
+        oligoNumArray = N.zeros(dimensions, float)
+        for n in range(0, numOligos):
+            oligoNumArray[n, :] = (n + 1)
+
+        # reshape arrays for plotting
+        numPoints = DNANArray.shape[0] * DNANArray.shape[1]
+        oligoNumPlotting = N.reshape(oligoNumArray, (numPoints,))
+        DNANPlotting = N.reshape(DNANArray, (numPoints,))
+        rNNPlotting = N.reshape(rNNArray, (numPoints,))
+
+        figFileRoot = graphDir + "DNANVsOligo"
+        plotUtils.createAndSaveFig(oligoNumPlotting, DNANPlotting, figFileRoot,
+                                   xLabel="Oligo", yLabel="Intensity", yMin=0,
+                                   xMin=0, xMax=numOligos)
+        figFileRoot = graphDir + "rNNVsOligo"
+        plotUtils.createAndSaveFig(oligoNumPlotting, rNNPlotting, figFileRoot,
+                                   xLabel="Oligo", yLabel="Ratio", yMin=0,
+                                   xMin=0, xMax=numOligos)
+
+        # now go through and make histograms of all DNABSub, Ratio, and
+        # RatioNorm values
+        figFileRoot = graphDir + '/DNANHist'
+        plotUtils.makeHist(DNAN, figFileRoot, numBins=1000, xLabel='DNAN',
+                           yLabel='Number of Events', log=False,
+                           removeNaNFlag=1)
+        figFileRoot = graphDir + '/DNANHistLog'
+        plotUtils.makeHist(DNAN, figFileRoot, numBins=1000, xLabel='DNAN',
+                           yLabel='Number of Events', log=True,
+                           removeNaNFlag=1)
+        figFileRoot = graphDir + '/rNNHist'
+        plotUtils.makeHist(rNN, figFileRoot, numBins=1000, xLabel='rNN',
+                           yLabel='Number of Events', log=False,
+                           removeNaNFlag=1)
+        figFileRoot = graphDir + '/rNNHistLog'
+        plotUtils.makeHist(rNN, figFileRoot, numBins=1000, xLabel='rNN',
+                           yLabel='Number of Events', log=True,
+                           removeNaNFlag=1)
+
+    return {'NumSpots': len(chip),
+            'NumFlagged': int(N.count_nonzero(chip.flag)),
+            'NumRatios': int(N.count_nonzero(~N.isnan(chip.ratio))),
+            'rNNFitMean': float(zD['rParams'][1]),
+            'rNNFitStd': float(zD['rParams'][2])}
 
 
 ##############################################
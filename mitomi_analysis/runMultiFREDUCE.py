@@ -1,5 +1,6 @@
 import sys
 import os
+import shutil
 from getopt import getopt
 
 HELP_STRING = """
@@ -55,7 +56,7 @@ def main(argv=None):
         print(HELP_STRING)
         sys.exit(1)
 
-    os.system('cp ' + seqFN + ' ' + seqFN + 'ta')
+    shutil.copyfile(seqFN, seqFN + 'ta')
 
     for a in range(6, 10):
         for b in range(0, 3):
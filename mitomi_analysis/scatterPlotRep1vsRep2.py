@@ -4,6 +4,7 @@ from getopt import getopt
 from . import plotUtils
 import numpy as N
 from . import fileIOUtils
+from . import chipSingleconcUtils
 from operator import itemgetter
 from scipy import stats
 
@@ -17,7 +18,8 @@ This program is designed to plot replicate 1 vs replicate 2
 for all oligos in a scatter plot.
 
      -h    print this help message
-     -c    concat_Processed.txt filename
+     -c    concat_Processed.txt filename (a column store saved alongside it
+           by process -b is read instead)
 
 """
 
@@ -59,47 +61,43 @@ def main(argv=None):
     rA = N.zeros(dimensions)
     dA = N.zeros(dimensions)
 
+    # read the oligo numbers, DNAN and rNN values (from the column store
+    # saved alongside the file, if there is one)
+    columnD = chipSingleconcUtils.loadProcessedColumns(
+        cFN, ['OligoNum', 'DNAN', 'rNN'])
+    oligoNums = columnD['OligoNum'].astype(int).tolist()
+    DNANs = columnD['DNAN'].astype(float).tolist()
+    rNNs = columnD['rNN'].astype(float).tolist()
+
     dD, rD = {}, {}
-    cF = open(cFN, 'r')
-    lI = 0
-    for line in cF:
-        lI = lI + 1
-        if lI == 1:
-            pass
-        else:
-            tempL = line.strip().split('\t')
-            if int(tempL[16]) in dD:
-                if len(dD[int(tempL[16])]) < 2:
-                    dD[int(tempL[16])].append(float(tempL[18]))
-                else:
-                    if (N.isnan(dD[int(tempL[16])][0]) and
-                        not N.isnan(dD[int(tempL[16])][1]) and
-                        not N.isnan(float(tempL[18]))):
-                        dD[int(tempL[16])][0] = (float(tempL[18]))
-                    elif (not N.isnan(dD[int(tempL[16])][0]) and
-                          N.isnan(dD[int(tempL[16])][1]) and
-                          not N.isnan(float(tempL[18]))):
-                        dD[int(tempL[16])][1] = (float(tempL[18]))
-                    else:
-                        pass
-            if int(tempL[16]) in rD:
-                if len(rD[int(tempL[16])]) < 2:
-                    rD[int(tempL[16])].append(float(tempL[20]))
+    for oligo, DNAN, rNN in zip(oligoNums, DNANs, rNNs):
+        if oligo in dD:
+            if len(dD[oligo]) < 2:
+                dD[oligo].append(DNAN)
+            else:
+                if (N.isnan(dD[oligo][0]) and not N.isnan(dD[oligo][1]) and
+                        not N.isnan(DNAN)):
+                    dD[oligo][0] = DNAN
+                elif (not N.isnan(dD[oligo][0]) and N.isnan(dD[oligo][1]) and
+                        not N.isnan(DNAN)):
+                    dD[oligo][1] = DNAN
                 else:
-                    if (N.isnan(rD[int(tempL[16])][0]) and
-                    not N.isnan(rD[int(tempL[16])][1]) and
-                    not N.isnan(float(tempL[20]))):
-                        rD[int(tempL[16])][0] = (float(tempL[20]))
-                    elif (not N.isnan(rD[int(tempL[16])][0]) and
-                    N.isnan(rD[int(tempL[16])][1]) and
-                    not N.isnan(float(tempL[20]))):
-                        rD[int(tempL[16])][1] = (float(tempL[20]))
-                    else:
-                        pass
+                    pass
+        if oligo in rD:
+            if len(rD[oligo]) < 2:
+                rD[oligo].append(rNN)
             else:
-                dD[int(tempL[16])] = [float(tempL[18])]
-                rD[int(tempL[16])] = [float(tempL[20])]
-    cF.close()
+                if (N.isnan(rD[oligo][0]) and not N.isnan(rD[oligo][1]) and
+                        not N.isnan(rNN)):
+                    rD[oligo][0] = rNN
+                elif (not N.isnan(rD[oligo][0]) and N.isnan(rD[oligo][1]) and
+                        not N.isnan(rNN)):
+                    rD[oligo][1] = rNN
+                else:
+                    pass
+        else:
+            dD[oligo] = [DNAN]
+            rD[oligo] = [rNN]
 
     dDL = sorted(list(dD.items()), key=itemgetter(0))
     rDL = sorted(list(rD.items()), key=itemgetter(0))
@@ -117,9 +115,9 @@ def main(argv=None):
         fileIOUtils.createNewDir(oDir)
 
     oFN1 = oDir + '/rNN_Rep1.dat'
-    oF1 = open(oFN1, 'w')
+    oF1 = fileIOUtils.openAtomic(oFN1, 'w')
     oFN2 = oDir + '/rNN_Rep2.dat'
-    oF2 = open(oFN2, 'w')
+    oF2 = fileIOUtils.openAtomic(oFN2, 'w')
     for b in range(0, 1458):
         oF1.write(str(rA[b][0]) + '\n')
         oF2.write(str(rA[b][1]) + '\n')
@@ -127,9 +125,9 @@ def main(argv=None):
     oF2.close()
 
     oFN1 = oDir + '/DNAN_Rep1.dat'
-    oF1 = open(oFN1, 'w')
+    oF1 = fileIOUtils.openAtomic(oFN1, 'w')
     oFN2 = oDir + '/DNAN_Rep2.dat'
-    oF2 = open(oFN2, 'w')
+    oF2 = fileIOUtils.openAtomic(oFN2, 'w')
     for b in range(0, 1458):
         oF1.write(str(dA[b][0]) + '\n')
         oF2.write(str(dA[b][1]) + '\n')
@@ -173,7 +171,7 @@ def main(argv=None):
 
     dCorr = stats.pearsonr(d1o, d2o)
     rCorr = stats.pearsonr(r1o, r2o)
-    oF = open('./Corr.txt', 'w')
+    oF = fileIOUtils.openAtomic('./Corr.txt', 'w')
     oF.write('DCorr\tRCorr\n')
     oF.write(str(dCorr[0]) + '\t' + str(rCorr[0]) + '\n')
     oF.close()
@@ -0,0 +1,152 @@
+import os
+import numpy as N
+from . import fileIOUtils
+
+# arrays saved when a layout is cached
+LAYOUT_ARRAYS = ['cols', 'rows', 'spotOligos', 'names', 'oligoNums',
+                 'oligoCounts', 'oligoGrid']
+
+
+class SpotLayout(object):
+    """This class holds a spot2oligo file as integer lookup arrays.  Each
+    distinct oligo name gets an index into names; oligoGrid[col, row] gives the
+    name index of the spot at that position (-1 where there is no spot)."""
+
+    __slots__ = ['fileName', 'cols', 'rows', 'spotOligos', 'names',
+                 'oligoNums', 'oligoCounts', 'oligoGrid', 'numOligos',
+                 'numSpotsPerOligo']
+
+    def __init__(self, fileName, cols, rows, oligoNames):
+
+        self.fileName = fileName
+        self.cols = N.asarray(cols, N.int32)
+        self.rows = N.asarray(rows, N.int32)
+
+        # index the oligo names in order of first appearance
+        names, firstIndex, spotOligos = N.unique(
+            N.asarray(oligoNames, str), return_index=True, return_inverse=True)
+        order = N.argsort(firstIndex, kind='stable')
+        rank = N.empty(len(order), N.int32)
+        rank[order] = N.arange(len(order))
+        self.names = names[order]
+        self.spotOligos = rank[spotOligos].astype(N.int32)
+
+        # oligo number of each name, e.g. 12 for Oligo_12 (-1 for EMPTY)
+        self.oligoNums = N.array([oligoNumber(name) for name in self.names],
+                                 N.int32)
+        self.oligoCounts = N.bincount(self.spotOligos,
+                                      minlength=len(self.names))
+
+        self.oligoGrid = N.full((self.cols.max(initial=0) + 1,
+                                 self.rows.max(initial=0) + 1), -1, N.int32)
+        self.oligoGrid[self.cols, self.rows] = self.spotOligos
+
+        # the number of oligos does not count Oligo_0, and the number of
+        # replicates is taken from Oligo_1
+        self.numOligos = N.count_nonzero(self.names != 'EMPTY') - 1
+        self.numSpotsPerOligo = int(N.sum(self.oligoCounts[self.names ==
+                                                           'Oligo_1']))
+
+    @classmethod
+    def fromArrays(cls, fileName, arrayD, header):
+        """This program rebuilds a layout from the arrays and header saved by
+        layoutColumns."""
+
+        layout = cls.__new__(cls)
+        layout.fileName = fileName
+        for name in LAYOUT_ARRAYS:
+            setattr(layout, name, arrayD[name])
+        layout.numOligos = header['numOligos']
+        layout.numSpotsPerOligo = header['numSpotsPerOligo']
+        return layout
+
+    def oligoIndex(self, colList, rowList):
+        """This program looks up the name index of each spot (-1 for spots
+        that are not in the layout)."""
+
+        cols = N.asarray(colList, int)
+        rows = N.asarray(rowList, int)
+        inGrid = ((cols >= 0) & (cols < self.oligoGrid.shape[0]) &
+                  (rows >= 0) & (rows < self.oligoGrid.shape[1]))
+        outIndex = N.full(len(cols), -1, N.int32)
+        outIndex[inGrid] = self.oligoGrid[cols[inGrid], rows[inGrid]]
+        return outIndex
+
+    def spotOligoNums(self, colList, rowList):
+        """This program looks up the oligo number of each spot (-1 for empty
+        spots and spots that are not in the layout)."""
+
+        spotOligos = self.oligoIndex(colList, rowList)
+        return N.where(spotOligos >= 0, self.oligoNums[spotOligos], -1)
+
+    def toDict(self):
+        """This program returns the layout as a dictionary linking "col.row"
+        spot indices to oligo names."""
+
+        return dict((str(self.cols[n]) + "." + str(self.rows[n]),
+                     str(self.names[self.spotOligos[n]]))
+                    for n in range(0, len(self.cols)))
+
+
+def oligoNumber(oligoName):
+    """This program returns the number of an oligo name such as Oligo_12, or
+    -1 for empty spots."""
+
+    if oligoName in ['Empty', 'EMPTY']:
+        return -1
+    return int(oligoName.split("_")[1].split(".")[0])
+
+
+def replicateIndex(oligoIndex):
+    """This program numbers the spots of each oligo 0, 1, 2, ... in the order
+    they are given."""
+
+    oligoIndex = N.asarray(oligoIndex)
+    order = N.argsort(oligoIndex, kind='stable')
+    sortedIndex = oligoIndex[order]
+    groupStart = N.ones(len(order), bool)
+    groupStart[1:] = sortedIndex[1:] != sortedIndex[:-1]
+    startPos = N.maximum.accumulate(N.where(groupStart,
+                                            N.arange(len(order)), 0))
+    outIndex = N.empty(len(order), N.int32)
+    outIndex[order] = N.arange(len(order)) - startPos
+    return outIndex
+
+
+def layoutColumns(spot2OligoFileName):
+    """This program parses a spot2oligo file and returns the layout arrays in
+    the form saved to the data cache."""
+
+    layoutFile = fileIOUtils.openFile(spot2OligoFileName, 'r')
+    data = N.loadtxt(layoutFile, dtype=str, delimiter='\t', skiprows=1,
+                     ndmin=2)
+    layoutFile.close()
+    data = N.char.strip(data)
+    layout = SpotLayout(spot2OligoFileName, data[:, 0].astype(int),
+                        data[:, 1].astype(int), data[:, 2])
+
+    return (LAYOUT_ARRAYS, [getattr(layout, name) for name in LAYOUT_ARRAYS],
+            {'numOligos': int(layout.numOligos),
+             'numSpotsPerOligo': int(layout.numSpotsPerOligo)})
+
+
+# parsed layouts, keyed by file path and checked against the file's mtime
+_layoutCache = {}
+
+
+def loadSpotLayout(spot2OligoFileName):
+    """This program reads a spot2oligo file into a SpotLayout object.  Layouts
+    are parsed once, saved to the data cache, and reused until the file
+    changes."""
+
+    path = os.path.abspath(spot2OligoFileName)
+    mtime = os.path.getmtime(path)
+    if path in _layoutCache and _layoutCache[path][0] == mtime:
+        return _layoutCache[path][1]
+
+    arrayD, header = fileIOUtils.loadCachedColumns(path, 'layout',
+                                                   layoutColumns)
+    layout = SpotLayout.fromArrays(spot2OligoFileName, arrayD, header)
+
+    _layoutCache[path] = (mtime, layout)
+    return layout
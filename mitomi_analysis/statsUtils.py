@@ -1,6 +1,7 @@
 import numpy as N
 import operator as O
 from scipy import stats
+from scipy import special
 
 
 def correlation_coef(list1, list2):
@@ -452,3 +453,58 @@ def fact(x):
         f = f * x
         x = x - 1
     return f
+
+
+def calcZScores(values, avg, sdev):
+    """This program calculates the z-scores of an array of values (NaN
+    values stay NaN)."""
+
+    return (N.asarray(values, float) - avg)/sdev
+
+
+def calcNormPValues(zScores, sides=1):
+    """This program calculates the p-values of an array of z-scores under
+    the standard normal distribution, one-sided (upper tail) or two-sided
+    (NaN z-scores give NaN p-values)."""
+
+    zScores = N.asarray(zScores, float)
+    if sides == 2:
+        return 2*special.ndtr(-N.abs(zScores))
+    return special.ndtr(-zScores)
+
+
+def calcBHQValues(pValues):
+    """This program calculates Benjamini-Hochberg q-values (false discovery
+    rate adjusted p-values) for an array of p-values, ignoring NaN values."""
+
+    pValues = N.asarray(pValues, float)
+    qValues = N.full(len(pValues), N.nan)
+    valid = N.flatnonzero(~N.isnan(pValues))
+    order = valid[N.argsort(pValues[valid], kind='stable')]
+
+    numTests = len(order)
+    scaled = pValues[order]*numTests/N.arange(1, numTests + 1)
+    # q-values are the running minimum from the largest p-value down
+    qValues[order] = N.minimum(N.minimum.accumulate(scaled[::-1])[::-1], 1)
+    return qValues
+
+
+def calcFisherCombinedPValues(pValues, groups, numGroups):
+    """This program combines the p-values of each group (e.g. the replicate
+    spots of an oligo) with Fisher's method.  groups gives the group index
+    of each p-value (-1 for none) and NaN p-values are left out.  It returns
+    the combined p-value of each group (NaN for groups without p-values)."""
+
+    pValues = N.asarray(pValues, float)
+    groups = N.asarray(groups)
+    use = (groups >= 0) & ~N.isnan(pValues)
+
+    # a p-value of 0 would make the statistic infinite
+    logP = N.log(N.maximum(pValues[use], N.finfo(float).tiny))
+    statistic = N.bincount(groups[use], weights=-2*logP, minlength=numGroups)
+    counts = N.bincount(groups[use], minlength=numGroups)
+
+    combined = N.full(numGroups, N.nan)
+    has = counts > 0
+    combined[has] = special.chdtrc(2*counts[has], statistic[has])
+    return combined
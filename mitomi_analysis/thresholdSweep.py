@@ -0,0 +1,157 @@
+import sys
+import os
+from getopt import getopt
+from . import chipSingleconcUtils
+import numpy as N
+from . import chipStages
+from . import fileIOUtils
+from . import spotLayout
+
+
+HELP_STRING = """
+sweep
+
+This program is designed to help choose the pBSub, DNABSub and chBSub
+thresholds for a chip.  It evaluates every combination of the threshold
+values given in one pass over the background subtracted data and writes a
+single table with, for each combination, the number of spots that pass, the
+number of oligos with two passing replicates, the correlation of the
+replicate ratios, and the Gaussian fit used to normalize the ratios.  No
+figures or per-combination files are written.
+
+Threshold values are given as a comma-separated list (e.g. -500,0,50) or as
+start:stop:step (e.g. -500:500:100, stop included).
+
+     -h     print this help message
+     -c     concat filename (required)
+     -s     spot2oligo filename (optional, default is
+            PR8MerSpot2OligoFile_4PinPrint_Stanford)
+     -p     pBSub threshold values (optional, default -500)
+     -d     DNABSub threshold values (optional, default -500)
+     -t     chBSub threshold values (optional, default -1000)
+     -o     output filename (optional, default is
+            <concat file>_ThresholdSweep.txt)
+     -z     do not use the stage cache (.mitomi_cache next to the concat
+            file, never pruned: delete it to clear the cache)
+
+Example:
+mitomi sweep -c concatFile_042108.txt -p 0:200:50 -d 0,50,100 -t 500
+"""
+
+# columns of the sweep table after the three thresholds
+SWEEP_COLUMNS = ['numSpots', 'numPairs', 'repCorr', 'ratioMean', 'ratioStd',
+                 'fitAmp', 'fitMean', 'fitStd']
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    concatFileName = ""
+
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+
+    spot2OligoFileName = \
+        os.path.join(data_dir, "PR8MerSpot2OligoFile_4PinPrint_Stanford.txt")
+    pThs = [-500]
+    DNAThs = [-500]
+    chThs = [-1000]
+    outFileName = ""
+    cacheFlag = 1
+
+    try:
+        optlist, args = getopt(argv[1:], "hc:s:p:d:t:o:z")
+    except:
+        print("")
+        print(HELP_STRING)
+        sys.exit(1)
+
+    if len(optlist) == 0:
+        print("")
+        print(HELP_STRING)
+        sys.exit(1)
+
+    for (opt, opt_arg) in optlist:
+        if opt == '-h':
+            print("")
+            print(HELP_STRING)
+            sys.exit(0)
+        elif opt == '-c':
+            concatFileName = opt_arg
+        elif opt == '-s':
+            spot2OligoFileName = opt_arg
+        elif opt == '-p':
+            pThs = parseThresholds(opt_arg)
+        elif opt == '-d':
+            DNAThs = parseThresholds(opt_arg)
+        elif opt == '-t':
+            chThs = parseThresholds(opt_arg)
+        elif opt == '-o':
+            outFileName = opt_arg
+        elif opt == '-z':
+            cacheFlag = 0
+
+    if concatFileName == "":
+        print(HELP_STRING)
+        sys.exit(1)
+
+    if outFileName == "":
+        outFileName = (fileIOUtils.fileRoot(concatFileName) +
+                       '_ThresholdSweep.txt')
+
+    stages = chipStages.getChipStages(concatFileName, spot2OligoFileName,
+                                      cacheFlag=cacheFlag)
+    sweepD = sweepChip(stages, pThs, DNAThs, chThs)
+    writeSweepTable(outFileName, pThs, DNAThs, chThs, sweepD)
+    print("Evaluated " + str(len(pThs)*len(DNAThs)*len(chThs)) +
+          " threshold combinations, written to " + outFileName)
+
+    return 0
+
+
+def parseThresholds(thString):
+    """This program reads threshold values given as a comma-separated list or
+    as start:stop:step (stop included)."""
+
+    if ':' in thString:
+        start, stop, step = [float(a) for a in thString.split(':')]
+        return N.arange(start, stop + 0.5*step, step).tolist()
+    return [float(a) for a in thString.split(',')]
+
+
+def sweepChip(stages, pThs, DNAThs, chThs):
+    """This program evaluates the threshold combinations for the chip handled
+    by a ChipStages object (see chipSingleconcUtils.sweepThresholds)."""
+
+    # background subtract the flagged chip once, without thresholds
+    pBSub, DNABSub, chBSub = stages.bgsub(None, None, None, 0)
+    ratio = stages.ratios(None, None, None, 0)[0]
+
+    chip = stages.load()
+    repSpots = chipSingleconcUtils.replicateSpots(stages.spot2OligoFileName,
+                                                  chip.col, chip.row)
+    # the last row holds the empty chambers of Oligo_0, which are not pairs
+    layout = spotLayout.loadSpotLayout(stages.spot2OligoFileName)
+    repSpots = repSpots[:layout.numOligos]
+
+    return chipSingleconcUtils.sweepThresholds(pBSub, DNABSub, chBSub, ratio,
+                                               repSpots, pThs, DNAThs, chThs)
+
+
+def writeSweepTable(fileName, pThs, DNAThs, chThs, sweepD):
+    """This program writes the sweep results as one tab-delimited table with a
+    row per threshold combination."""
+
+    grids = N.meshgrid(pThs, DNAThs, chThs, indexing='ij')
+    table = N.column_stack([grid.ravel() for grid in grids] +
+                           [sweepD[name].ravel() for name in SWEEP_COLUMNS])
+    outFile = fileIOUtils.openAtomic(fileName, 'w')
+    N.savetxt(outFile, table, fmt='%.6g', delimiter='\t',
+              header='\t'.join(['pTh', 'DNATh', 'chTh'] + SWEEP_COLUMNS),
+              comments='')
+    outFile.close()
+
+
+##############################################
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,8 +12,11 @@ setup(name='mitomi_analysis',
       setup_requires=["numpy"],
       install_requires=[
         'matplotlib',
-        'numpy',
+        'numpy>=1.23',
         'scipy',
       ],
+      extras_require={
+        'zstd': ['zstandard'],
+      },
       scripts=['bin/mitomi'],
       zip_safe=False)